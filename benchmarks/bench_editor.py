@@ -0,0 +1,59 @@
+"""
+Keystroke to paint time of the record editor on a large body, measured headlessly: each key is handled by the
+widgets as in INSERT mode, then the screen is rendered and its canvas read as a terminal would draw it.
+Run from the repository root with: python -m benchmarks.bench_editor [<lines>]
+"""
+import random
+import string
+import sys
+import time
+
+from src.ui import WidgetController
+
+SIZE = (100, 30)
+
+
+def make_body(lines, rng):
+    return '\n'.join(' '.join(''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 9)))
+                              for _ in range(rng.randint(0, 12))) for _ in range(lines))
+
+def press(widgets, key):
+    """ :returns: seconds from handling key to the rendered canvas being read """
+    start = time.perf_counter()
+    widgets.keypress(SIZE, key)
+    canvas = widgets.render(SIZE, focus=True)
+    for row in canvas.content():
+        pass
+    return time.perf_counter() - start
+
+def summary(name, latencies):
+    ordered = sorted(latencies)
+    percentile = lambda p: ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000
+    print('{:<14} {:>5} keys  median {:>6.2f}ms  p95 {:>6.2f}ms  max {:>6.2f}ms'.format(
+        name, len(ordered), percentile(0.5), percentile(0.95), ordered[-1] * 1000))
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    rng = random.Random(0)
+    widgets = WidgetController()
+    widgets.set_widget_text({'interaction_mode':'INSERT', 'view_mode':'RAW', 'title':'benchmark', 'body':make_body(lines, rng)})
+    widgets.body.keyword_widget_handler()
+    widgets.body.record_body.focus_line(lines // 2, 0)
+    widgets.render(SIZE, focus=True)
+
+    scenarios = [
+        ('typing', [ rng.choice(string.ascii_lowercase + ' ') for _ in range(500) ]),
+        ('enter/delete', [ 'enter', 'backspace' ] * 100),
+        ('arrows', [ rng.choice(['up', 'down', 'left', 'right']) for _ in range(500) ]),
+        ('page up/down', [ 'page down' ] * 50 + [ 'page up' ] * 50),
+    ]
+    print('{} line body'.format(lines))
+    every = []
+    for name, keys in scenarios:
+        latencies = [ press(widgets, key) for key in keys ]
+        summary(name, latencies)
+        every.extend(latencies)
+    summary('all', every)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Time to rank records with the bounded top n heap of score_partition and score_parallel against scoring every
+record with token_sort_ratio and sorting them all, as fuzzy_match did before.
+Run from the repository root with: python -m benchmarks.bench_rank [<records>]
+"""
+import os
+import random
+import string
+import sys
+import time
+
+from fuzzywuzzy import fuzz
+
+from src.fuzzy import sort_tokens, score_partition, score_parallel
+
+
+def baseline_top_n(items, query, n):
+    scored = [ (fuzz.token_sort_ratio(tokens, query), index) for index, tokens in items ]
+    return sorted(scored, key=lambda pair: pair[0])[-n:]
+
+def make_items(count, rng):
+    words = [ ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 9))) for _ in range(20000) ]
+    return [ (i, ' '.join(rng.choice(words) for _ in range(rng.randint(2, 8)))) for i in range(count) ]
+
+def measure(name, func):
+    start = time.perf_counter()
+    result = func()
+    print('{:<24} {:>8.2f}s'.format(name, time.perf_counter() - start))
+    return result
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rng = random.Random(0)
+    items = make_items(count, rng)
+    query = ' '.join(items[rng.randrange(count)][1].split()[:2])
+    n = 10
+    print('{} records, top {} of query \'{}\''.format(count, n, query))
+
+    expected = measure('sorted()[-n:]', lambda: baseline_top_n(items, query, n))
+    result = measure('score_partition', lambda: score_partition((items, sort_tokens(query), n)))
+    jobs = os.cpu_count() or 1
+    parallel = measure('score_parallel ({} jobs)'.format(jobs), lambda: score_parallel(items, sort_tokens(query), n, jobs))
+    print('identical results: {}'.format(result == expected and parallel == expected))
+
+if __name__ == '__main__':
+    main()
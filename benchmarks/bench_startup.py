@@ -0,0 +1,68 @@
+"""
+Cumulative import time of each entry point as reported by python -X importtime, and whether the modules only some
+entry points need were loaded by the others.
+Run from the repository root with: python -m benchmarks.bench_startup [<runs>]
+"""
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+# Modules only some entry points should load, urwid for the record editor, fuzzywuzzy for the fuzzy scorer
+# and pkg_resources for --version
+OPTIONAL_MODULES = ['urwid', 'fuzzywuzzy', 'pkg_resources']
+
+# Name, arguments, stdin and the optional modules the entry point needs
+ENTRY_POINTS = [
+    ('search', ['alpha'], '\n', {'fuzzywuzzy'}),
+    ('search fts', ['--scorer', 'fts', 'alpha'], '\n', set()),
+    ('import', ['import', '--force', '{import_fp}'], '', set()),
+    ('export', ['export', '{export_dp}'], 'y\n', set()),
+    ('version', ['--version'], '', {'pkg_resources'}),
+]
+
+_importtime_pattern = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def run(args, stdin, home):
+    """ :returns: dict of top level module name to cumulative import time in microseconds """
+    env = dict(os.environ, HOME=home)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'src', *args], input=stdin, env=env,
+                          capture_output=True, text=True)
+    modules = {}
+    for match in _importtime_pattern.finditer(proc.stderr):
+        cumulative, indent, name = int(match.group(2)), match.group(3), match.group(4)
+        # Modules imported directly by the entry point rather than by another module
+        if len(indent) == 1:
+            modules[name] = modules.get(name, 0) + cumulative
+        else:
+            modules.setdefault(name, 0)
+    return modules
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    with tempfile.TemporaryDirectory() as home:
+        import_fp = os.path.join(home, 'records.json')
+        with open(import_fp, 'w') as f:
+            json.dump([ {'title':'alpha {}'.format(i), 'keywords':'notes', 'body':''} for i in range(100) ], f)
+        # Creates the database so every measured run opens an existing one
+        run(['import', import_fp], '', home)
+
+        print('{:<12} {:>12}  {}'.format('entry point', 'import time', '  '.join(OPTIONAL_MODULES)))
+        for name, args, stdin, needed in ENTRY_POINTS:
+            args = [ arg.format(import_fp=import_fp, export_dp=home) for arg in args ]
+            totals = []
+            for _ in range(runs):
+                modules = run(args, stdin, home)
+                totals.append(sum(modules.values()))
+            loaded = [ 'yes' if module in modules else 'no' for module in OPTIONAL_MODULES ]
+            unexpected = [ module for module in OPTIONAL_MODULES if module in modules and module not in needed ]
+            print('{:<12} {:>10.1f}ms  {}{}'.format(
+                name, sorted(totals)[len(totals) // 2] / 1000,
+                '  '.join('{:<{}}'.format(l, len(m)) for l, m in zip(loaded, OPTIONAL_MODULES)).rstrip(),
+                '  unexpectedly loaded: {}'.format(', '.join(unexpected)) if unexpected else ''))
+
+if __name__ == '__main__':
+    main()
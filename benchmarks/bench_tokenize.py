@@ -0,0 +1,38 @@
+"""
+Tokens per second of util.standardize against the shlex implementation it replaced.
+Run from the repository root with: python -m benchmarks.bench_tokenize
+"""
+import random
+import shlex
+import string
+import time
+
+from src import util
+
+
+def shlex_standardize(s):
+    exclusions = ['\'','"', '=']
+    stripped = ''.join(c for c in s if c not in string.punctuation or c in exclusions).lower()
+    return list(shlex.shlex(stripped))
+
+def make_texts(count, rng):
+    words = [ ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 10))) for _ in range(5000) ]
+    return [ ' '.join(rng.choice(words) + rng.choice(['', '', ',', '!', '=x']) for _ in range(rng.randint(3, 12)))
+             for _ in range(count) ]
+
+def measure(name, standardize, texts):
+    start = time.perf_counter()
+    token_count = sum(len(list(standardize(s))) for s in texts)
+    elapsed = time.perf_counter() - start
+    print('{:<20} {:>12,.0f} tokens/sec'.format(name, token_count / elapsed))
+
+def main():
+    texts = make_texts(50000, random.Random(0))
+    measure('shlex', shlex_standardize, texts)
+    measure('util.standardize', util.standardize, texts)
+    start = time.perf_counter()
+    token_count = sum(len(tokens) for tokens in util.standardize_many(texts))
+    print('{:<20} {:>12,.0f} tokens/sec'.format('util.standardize_many', token_count / (time.perf_counter() - start)))
+
+if __name__ == '__main__':
+    main()
@@ -13,9 +13,12 @@ setup(
         'docopt >= 0.6.2',
         'fuzzywuzzy >= 0.8.1',
         'pathlib',
-        'SQLAlchemy >= 1.0.9',
+        'SQLAlchemy >= 1.4',
         'urwid >= 1.3.1',
     ],
+    extras_require={
+        'ngram': ['numpy'],
+    },
     entry_points={
         'console_scripts': [
             'memfog = src.__main__:main'
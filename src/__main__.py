@@ -1,20 +1,26 @@
 """
 
-Usage: memfog add
-       memfog remove [--top <n> <keyword>...]
-       memfog import [--force] <filepath>
-       memfog export [<dirpath>]
-       memfog [--top <n> --raw <keyword>...]
+Usage: memfog add [--writer <model> --event-loop <name>]
+       memfog remove [--top <n> --scorer <name> --jobs <n> --writer <model> <keyword>...]
+       memfog import [--force --writer <model>] <filepath>...
+       memfog export [--since <time>] [<dirpath>]
+       memfog [--interactive --top <n> --scorer <name> --jobs <n> --writer <model> --event-loop <name> --raw <keyword>...]
 
 Options:
-  -f --force    Overwrite existing records with imported records if same title
-  -h --help     Show this screen
-  -t --top <n>  Limit results to top n records [default: 10]
-  -v --version  Show version
+  -e --event-loop <name>  Event loop running the record editor, select or asyncio [default: select]
+  -f --force              Overwrite existing records with imported records if same title
+  -h --help               Show this screen
+  -i --interactive        Pick the record from matches ranked again as the query is typed
+  -j --jobs <n>           Score large record stores across n processes, 0 for one per cpu [default: 0]
+  -s --scorer <name>      Ranking method, fuzzy, fts or ngram [default: fuzzy]
+  --since <time>          Only export changes after time, a UTC ISO 8601 timestamp or last for the previous export
+  -t --top <n>            Limit results to top n records [default: 10]
+  -v --version            Show version
+  -w --writer <model>     Apply database writes in a separate process or thread [default: process]
 
 """
-import pkg_resources
 from docopt import docopt
+import datetime
 import sys
 import os
 
@@ -24,6 +30,13 @@ from .file_sys import Path
 from . import util
 
 
+class Version:
+    """ Resolves the installed version only when docopt prints it for --version, pkg_resources is slow to import """
+    def __str__(self):
+        import pkg_resources
+        return pkg_resources.require('memfog')[0].version
+
+
 class Config:
     def __init__(self, argv):
         self.home_dp = os.path.expanduser('~')
@@ -35,6 +48,7 @@ class Config:
         file_sys.init_dir(self.data_dp)
 
         self.force_import = argv['--force']
+        self.interactive = argv['--interactive']
         self.top_n = argv['--top']
 
         if self.top_n:
@@ -43,9 +57,102 @@ class Config:
             else:
                 sys.exit('Invalid list size entry \'{}\''.format(self.top_n))
 
+        self.scorer = argv['--scorer']
+        if self.scorer not in ('fuzzy', 'fts', 'ngram'):
+            sys.exit('Invalid scorer \'{}\''.format(self.scorer))
+
+        self.jobs = argv['--jobs']
+        if util.is_valid_input(self.jobs):
+            self.jobs = int(self.jobs) or os.cpu_count() or 1
+        else:
+            sys.exit('Invalid job count \'{}\''.format(self.jobs))
+
+        # Minimum number of records scored before fuzzy matching is spread across jobs processes
+        self.parallel_threshold = 50000
+
+        self.event_loop = argv['--event-loop']
+        if self.event_loop not in ('select', 'asyncio'):
+            sys.exit('Invalid event loop \'{}\''.format(self.event_loop))
+
+        self.writer = argv['--writer']
+        if self.writer not in ('process', 'thread'):
+            sys.exit('Invalid writer \'{}\''.format(self.writer))
+
+        # Writes the database writer failed to apply are logged here with their traceback
+        self.writer_log_fp = Path(self.data_dp, 'writer.log')
+
+        # Number of imported records sent to the writer at a time
+        self.import_batch_size = 1000
+
+        # Number of records read from the database at a time when exporting
+        self.export_batch_size = 1000
+
+        # Holds the UTC time of the most recent export, which --since last continues from
+        self.export_watermark_fp = Path(self.data_dp, 'last_export')
+
+        self.export_since = argv['--since']
+        if self.export_since == 'last':
+            try:
+                with open(str(self.export_watermark_fp)) as f:
+                    self.export_since = f.read().strip()
+            except OSError:
+                sys.exit('No previous export to continue from')
+        if self.export_since is not None:
+            try:
+                self.export_since = datetime.datetime.fromisoformat(self.export_since)
+            except ValueError:
+                sys.exit('Invalid timestamp \'{}\''.format(self.export_since))
+            if self.export_since.tzinfo is not None:
+                self.export_since = self.export_since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+        # Applied to every sqlite connection. WAL stops readers from blocking on the writer and
+        # large scans read through memory mapped I/O. FULL syncs the WAL at every commit, so a save the writer
+        # has acknowledged survives a power loss. NORMAL commits faster but can lose the most recent
+        # acknowledged saves on power loss
+        self.sqlite_pragmas = {
+            'journal_mode': 'WAL',
+            'synchronous': 'FULL',
+            'cache_size': -64000,
+            'mmap_size': 268435456,
+            'temp_store': 'MEMORY'
+        }
+
+        # Text interpreted from PATH and EXEC instructions is cached here between sessions, keeping the most
+        # recently used entries
+        self.interpretation_cache_fp = Path(self.data_dp, 'interpretations.json')
+        self.interpretation_cache_size = 256
+        # Characters of interpreted text above which it is read again each time rather than cached
+        self.interpretation_cache_text_limit = 65536
+
+        # Seconds EXEC output is cached for unless the instruction sets its own, e.g. [EXEC:ttl=30](cmd).
+        # Commands are run every time a record is opened by default
+        self.exec_cache_ttl = 0
+
+        # Seconds given to interpret every PATH and EXEC instruction of a record, they are resolved concurrently
+        self.interpret_timeout = 5
+
+        # Bytes of EXEC output kept, the command is killed once it writes more
+        self.exec_output_limit = 1048576
+
+        # Bytes of a PATH file shown unless the instruction selects a window of it, e.g. [PATH:tail=100](file)
+        self.path_size_limit = 1048576
+
+        # Follow changes to the PATH sources of an open record in the background, with inotify where available
+        # and otherwise by checking them every watch_interval seconds
+        self.watch_sources = True
+        self.watch_interval = 0.5
+
+        # Matches listed by the interactive picker, and seconds it ranks for at a time before reading input again.
+        # Queries matching many records are ranked over several of these slices
+        self.picker_size = 100
+        self.picker_budget = 0.008
+
+        # BM25 weight of title, keywords and body matches when using the fts scorer
+        self.fts_weights = (10.0, 5.0, 1.0)
+
 
 def main():
-    argv = docopt(__doc__, version=pkg_resources.require('memfog')[0].version)
+    argv = docopt(__doc__, version=Version())
 
     mf.config = Config(argv)
     memfog = mf.Memfog()
@@ -60,8 +167,11 @@ def main():
         memfog.export_recs(argv['<dirpath>'])
     elif argv['import']:
         memfog.import_recs(argv['<filepath>'])
-    elif len(memfog.record_group) > 0:
-        memfog.display_rec(user_input)
+    elif memfog.record_count() > 0:
+        if mf.config.interactive:
+            memfog.pick_rec(user_input)
+        else:
+            memfog.display_rec(user_input)
     else:
         print('No memories exist')
 
@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+import time
+
+
+class InterpretationCache:
+    """
+    Text interpreted from PATH and EXEC instructions, persisted between sessions so opening a record doesn't
+    re-read every linked file and re-run every command.
+    PATH entries are valid while the file keeps the mtime, size and inode it had when read.
+    EXEC entries are valid until their time to live runs out.
+    The file is only written once an entry is added, when last used times updated by hits are saved with it.
+    """
+    def __init__(self, cache_fp, max_entries=256, max_text_len=65536):
+        """ :param max_text_len: characters of interpreted text above which it isn't cached """
+        self.cache_fp = str(cache_fp)
+        self.max_entries = max_entries
+        self.max_text_len = max_text_len
+        self.entries = {}
+        self.altered = False
+        # Instructions are interpreted concurrently, entries are only read and changed while holding the lock
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.cache_fp, 'r') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            # Missing or unreadable cache, every instruction gets interpreted again
+            self.entries = {}
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        if not self.altered:
+            return
+
+        # Keep the most recently used entries so the cache doesn't grow with every file ever linked
+        if len(self.entries) > self.max_entries:
+            recent = sorted(self.entries.items(), key=lambda item: item[1]['used'])[-self.max_entries:]
+            self.entries = dict(recent)
+
+        try:
+            with open(self.cache_fp, 'w') as f:
+                json.dump(self.entries, f)
+            self.altered = False
+        except OSError:
+            pass
+
+    @staticmethod
+    def make_key(instruction_key, instruction_val):
+        return '{}:{}'.format(instruction_key, instruction_val)
+
+    @staticmethod
+    def stamp(fp):
+        """ :returns: [mtime, size, inode] of the file at fp, None if it can't be read """
+        try:
+            stat = os.stat(fp)
+        except OSError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+
+    def get(self, key):
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            # Not worth rewriting the file for, saved along with the next entry added
+            entry['used'] = time.time()
+            return entry['text']
+
+    def get_path(self, fp, variant=''):
+        """
+        :param variant: distinguishes different windows of the same file
+        :returns: cached text of the file at fp, None if absent or the file changed since it was cached
+        """
+        key = self.make_key('PATH' + variant, fp)
+        stamp = self.stamp(fp)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry['stamp'] == stamp:
+                return self._get(key)
+
+    def set_path(self, fp, stamp, text, variant=''):
+        """ :param stamp: InterpretationCache.stamp of fp taken before it was read """
+        if stamp is not None and len(text) <= self.max_text_len:
+            with self.lock:
+                self.entries[self.make_key('PATH' + variant, fp)] = {'stamp':stamp, 'text':text, 'used':time.time()}
+                self.altered = True
+
+    def get_exec(self, cmd):
+        """ :returns: cached output of cmd, None if absent or expired """
+        key = self.make_key('EXEC', cmd)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry['expires'] > time.time():
+                return self._get(key)
+
+    def set_exec(self, cmd, text, ttl):
+        """ :param ttl: seconds the output stays valid, output is not cached unless greater than 0 """
+        if ttl > 0 and len(text) <= self.max_text_len:
+            now = time.time()
+            with self.lock:
+                self.entries[self.make_key('EXEC', cmd)] = {'expires':now + ttl, 'text':text, 'used':now}
+                self.altered = True
@@ -1,9 +1,41 @@
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
 import re
 import os
-import copy
+import selectors
+import signal
 import subprocess
+import time
 
 from . import file_io
+from . import memfog
+from .cache import InterpretationCache
+
+INSTRUCTION_PATTERN = re.compile(
+"""                 # ?: denotes non-capture group - group that must be matched but excluded from the result
+    (?:\[)          # Match \[
+    (PATH|EXEC)     # Text between braces can be either PATH or EXEC
+    (?::([^\]]*))?  # Optional comma separated name=value options, e.g. [EXEC:ttl=30]
+    (?:\]\()        # Match \]\(
+    (.*?)           # >= 0 characters between parenthesis
+    (?:\))          # Macth \)
+""", re.VERBOSE)
+
+# Maximum number of instructions of a record resolved at the same time
+MAX_WORKERS = 16
+
+
+def parse_options(text):
+    """
+    :param text: comma separated name=value options of an instruction, may be None
+    :returns: dict of option name to value
+    """
+    options = {}
+    for option in (text or '').split(','):
+        name, _, value = option.partition('=')
+        if name.strip():
+            options[name.strip()] = value.strip()
+    return options
 
 
 class TextField:
@@ -11,6 +43,9 @@ class TextField:
     def __init__(self, text):
         self.text = text
         self.instructions = []
+        # Text the instructions were parsed from and the text interpreted from them
+        self.source_text = text
+        self.interpretation = text
         self.starting_state = hash(self.text)
 
     def is_altered(self):
@@ -51,80 +86,300 @@ class Raw:
             vars(self)[attr_id].text = attr_val
 
 
+def parse_window(options):
+    """
+    :returns: file_io.str_window_from_file keyword arguments for the head, tail or lines option of a PATH instruction,
+              e.g. [PATH:tail=100](file) or [PATH:lines=20-40](file)
+    :raises ValueError: if the option isn't a line count or range
+    """
+    if 'lines' in options:
+        first, _, last = options['lines'].partition('-')
+        return {'lines':(int(first), int(last or first))}
+    if 'head' in options:
+        return {'head':int(options['head'])}
+    if 'tail' in options:
+        return {'tail':int(options['tail'])}
+    return {}
+
+def resolve_path(fp, options, cache=None, use_cache=True):
+    """
+    :returns: (text, partial) where text is the window of the file at fp given by options with tabs expanded and
+              partial is True unless text is the whole file
+    """
+    window = parse_window(options)
+    variant = ''.join(':{}={}'.format(name, value) for name, value in sorted(window.items()))
+    limit = memfog.config.path_size_limit
+
+    stamp = cache.stamp(fp) if cache else None
+    file_content = cache.get_path(fp, variant) if cache and use_cache else None
+    if file_content is not None:
+        return file_content, len(window) > 0 or stamp[1] > limit
+
+    file_content, partial = file_io.str_window_from_file(fp, limit=limit, **window)
+    file_content = file_content.expandtabs(tabsize=4)
+    if partial and len(window) == 0:
+        file_content += '\n[Truncated to {} bytes, a head, tail or lines option shows another part]'.format(limit)
+    if cache:
+        cache.set_path(fp, stamp, file_content, variant)
+    return file_content, partial
+
+def read_output(proc, deadline, limit):
+    """
+    Read the stdout and stderr of proc as they're written, stopping once limit bytes have been read
+    :returns: (stdout, stderr, truncated) bytes read, None if deadline passed before both were closed
+    """
+    outputs = { proc.stdout:[], proc.stderr:[] }
+    read = 0
+    with selectors.DefaultSelector() as selector:
+        for pipe in outputs:
+            selector.register(pipe, selectors.EVENT_READ)
+        while len(selector.get_map()) > 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            for key, events in selector.select(timeout=remaining):
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                    continue
+                outputs[key.fileobj].append(chunk)
+                read += len(chunk)
+                if read >= limit:
+                    return b''.join(outputs[proc.stdout]), b''.join(outputs[proc.stderr]), True
+    return b''.join(outputs[proc.stdout]), b''.join(outputs[proc.stderr]), False
+
+def resolve_exec(cmd, options, deadline, cache=None, use_cache=True):
+    """
+    :param deadline: time.monotonic() time the command is killed at if it hasn't exited
+    :returns: stdout followed by stderr of cmd, None if it timed out
+    """
+    exec_ttl = memfog.config.exec_cache_ttl
+    try:
+        ttl = float(options.get('ttl', exec_ttl))
+    except ValueError:
+        ttl = exec_ttl
+    # Output cached by another instruction running the same command is only used by ones that cache too
+    proc_result = cache.get_exec(cmd) if cache and use_cache and ttl > 0 else None
+    if proc_result is not None:
+        return proc_result
+
+    limit = memfog.config.exec_output_limit
+    # A session of its own lets the whole process group be killed, not only the shell running cmd
+    popen_args = {'stdout':subprocess.PIPE, 'stderr':subprocess.PIPE, 'shell':True, 'start_new_session':True}
+    with subprocess.Popen(cmd, **popen_args) as proc:
+        output = read_output(proc, deadline, limit)
+        try:
+            if output is None or output[2]:
+                raise subprocess.TimeoutExpired(cmd, 0)
+            proc.wait(timeout=max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+
+    if output is None:
+        return None
+    std_out, std_err, truncated = output
+    proc_result = (std_out + std_err)[:limit].decode(errors='replace')
+    if truncated:
+        proc_result += '\n[Output truncated to {} bytes]'.format(limit)
+    elif cache:
+        cache.set_exec(cmd, proc_result, ttl)
+    return proc_result
+
+class Instruction:
+    """ An instruction embedded in the raw text of a field, where it is and the text interpreted from it """
+    def __init__(self, match):
+        self.key, self.option_text, val = match.groups()
+        self.options = parse_options(self.option_text)
+        self.val = ' '.join(map(os.path.expanduser, val.split()))
+        # Position of the instruction in the raw text it was parsed from
+        self.span = match.span()
+        # InterpretationCache.stamp of a PATH source when it was read
+        self.stamp = None
+        self.text = None
+        # True unless text is the whole of a PATH source, partial sources are never written back to
+        self.partial = True
+
+    def is_same(self, other):
+        return (self.key, self.option_text, self.val) == (other.key, other.option_text, other.val)
+
+    def is_current(self):
+        """ PATH text is current while its source is unchanged, commands are always run again """
+        return self.key == 'PATH' and self.text is not None and InterpretationCache.stamp(self.val) == self.stamp
+
+    def reuse(self, other):
+        self.stamp, self.text, self.partial = other.stamp, other.text, other.partial
+
+    def resolve(self, deadline, cache=None, use_cache=True):
+        """
+        Interpret the instruction from its source. The result is returned rather than set so a worker finishing
+        after the deadline can't change an instruction already shown as timed out.
+        :returns: (stamp, text, partial) where text is None if it timed out
+        """
+        if self.key == 'PATH':
+            stamp = InterpretationCache.stamp(self.val)
+            return (stamp, *resolve_path(self.val, self.options, cache, use_cache))
+        return None, resolve_exec(self.val, self.options, deadline, cache, use_cache), False
+
+
 class Interpreted(Raw):
     """
     Contains interpreted text from embedded instructions in the raw text (if any) for each UI field.
     Enables switching view modes without exiting UI.
     """
-    def __init__(self, record):
+    def __init__(self, record, cache=None):
+        """ :type cache: cache.InterpretationCache or None to always interpret instructions """
         super(Interpreted, self).__init__(record)
-        self.title = self.interpret_field(self.title)
-        self.keywords = self.interpret_field(self.keywords)
-        self.body = self.interpret_field(self.body)
+        self.interpret_fields([self.title, self.keywords, self.body], cache)
+
+    @staticmethod
+    def interpret_fields(fields, cache=None, reusable=(), use_cache=True):
+        """
+        Parse the text of each field, extract embedded instructions, and replace each instruction with the text
+        interpretted from it. Every instruction is resolved concurrently under one deadline so a record takes as
+        long as its slowest instruction rather than all of them together. Instructions not resolved in time are
+        replaced with a note saying so.
+        :param reusable: Instructions interpreted before. An identical instruction takes their text while it is
+                         current, otherwise it is interpreted again.
+        :param use_cache: False to interpret from the sources themselves, bypassing the cache
+        """
+        timeout = memfog.config.interpret_timeout
+        deadline = time.monotonic() + timeout
+
+        pending = []
+        for field in fields:
+            field.source_text = field.text
+            for match in INSTRUCTION_PATTERN.finditer(field.text):
+                instruction = Instruction(match)
+                field.instructions.append(instruction)
+                previous = next(( other for other in reusable if instruction.is_same(other) ), None)
+                if previous is not None and previous.is_current():
+                    instruction.reuse(previous)
+                else:
+                    pending.append(instruction)
+
+        if len(pending) > 0:
+            executor = ThreadPoolExecutor(max_workers=min(len(pending), MAX_WORKERS))
+            futures = [ executor.submit(instruction.resolve, deadline, cache, use_cache) for instruction in pending ]
+            concurrent.futures.wait(futures, timeout=max(0, deadline - time.monotonic()))
+            # Reads still blocked past the deadline are left to finish in the background rather than hold up
+            # the record
+            executor.shutdown(wait=False)
+
+            for instruction, future in zip(pending, futures):
+                if not future.done():
+                    continue
+                try:
+                    instruction.stamp, instruction.text, instruction.partial = future.result()
+                except Exception as e:
+                    instruction.text = 'Error occured while interpreting {}\n{}'.format(instruction.val, e.args)
+
+        for field in fields:
+            if field.is_interpreted():
+                field.text = field.interpretation = Interpreted.splice(field, timeout)
+
+    @staticmethod
+    def splice(field, timeout):
+        """ :returns: source_text of field with its instructions replaced by their text, by position """
+        pieces = []
+        end = 0
+        for instruction in field.instructions:
+            text = instruction.text
+            if text is None:
+                text = '{} timed out after {}s: {}'.format(instruction.key, timeout, instruction.val)
+            pieces.extend([ field.source_text[end:instruction.span[0]], text ])
+            end = instruction.span[1]
+        pieces.append(field.source_text[end:])
+        return ''.join(pieces)
 
-    def interpret_field(self, field):
+    def refresh_from_sources(self, raw_data, cache=None):
         """
-        Parse text_field text, extract embedded instructions, and replace the instruction with the text
-        interpretted from it.
+        Reinterpret the fields whose raw text was edited, whose interpreted text was edited, or that depend on a
+        changed source, leaving other fields as they are. Instructions reading an unchanged PATH source keep their
+        text, the rest are interpreted again bypassing the cache.
         """
-        pattern = re.compile(
-        """                 # ?: denotes non-capture group - group that must be matched but excluded from the result
-            (?:\[)          # Match \[
-            (PATH|EXEC)     # Text between braces can be either PATH or EXEC
-            (?:\]\()        # Match \]\(
-            (.*?)           # >= 0 characters between parenthesis
-            (?:\))          # Macth \)
-        """, re.VERBOSE)
-
-        for match in pattern.finditer(field.text):
-            key, val = match.groups()
-            val = ' '.join(map(os.path.expanduser, val.split()))
-            field.instructions.append(tuple([key, val]))
-
-            if key == 'PATH':
-                file_content = file_io.str_from_file(val).expandtabs(tabsize=4)
-                field.text = field.text.replace(match.group(0), file_content)
-
-            elif key == 'EXEC':
-                proc = subprocess.Popen(val, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-                std_out, std_err = proc.communicate(timeout=5)
-                proc.wait(timeout=5)
-                proc_result = std_out.decode() + std_err.decode()
-                field.text = field.text.replace(match.group(0), proc_result)
-
-        # Even though all instructions are correctly interpretted, some of the embedded instructions still exist in
-        # the text for the field in which the instruction exists in addition to the content interpreted from them.
-        # Substitute any remaining instructions with empty string temporarily so they don't appear in UI
-        field.text = re.sub(pattern, '', field.text)
-        return field
-
-    def refresh_from_sources(self, raw_data):
-        """ Reintpret raw field text and and set to interpreted field to reflect any changes in linked sources """
-        self.title = self.interpret_field(raw_data.title)
-        self.keywords = self.interpret_field(raw_data.keywords)
-        self.body = self.interpret_field(raw_data.body)
+        stale = []
+        for field_name, raw_field in vars(raw_data).items():
+            field = vars(self)[field_name]
+            if field.source_text != raw_field.text or \
+                    (field.is_interpreted() and field.text != field.interpretation) or \
+                    not all(instruction.is_current() for instruction in field.instructions):
+                stale.append((field_name, field))
+
+        fields = [ type(field)(vars(raw_data)[field_name].text) for field_name, field in stale ]
+        reusable = [ instruction for field_name, field in stale for instruction in field.instructions ]
+        self.interpret_fields(fields, cache, reusable, use_cache=False)
+        for (field_name, field), refreshed_field in zip(stale, fields):
+            vars(self)[field_name] = refreshed_field
 
 
 class Data:
-    def __init__(self, record):
+    def __init__(self, record, cache=None):
+        self.cache = cache
         self.raw = Raw(record)
-        self.interpreted = Interpreted(record)
+        self.interpreted = Interpreted(record, cache)
         self.is_interpreted = self.raw.dump() != self.interpreted.dump()
+        if cache is not None:
+            cache.save()
 
     def refresh_interpretation(self):
+        """ Update interpreted fields to reflect the current raw field text and any changes in linked sources """
+        self.interpreted.refresh_from_sources(self.raw, self.cache)
+        self.is_interpreted = self.raw.dump() != self.interpreted.dump()
+        if self.cache is not None:
+            self.cache.save()
+
+    def watched_sources(self):
+        """ :returns: set of the paths read by PATH instructions of the interpreted fields """
+        return { instruction.val for field_obj in vars(self.interpreted).values()
+                 for instruction in field_obj.instructions if instruction.key == 'PATH' }
+
+    def read_sources(self, paths):
         """
-        Update interpreted field to use values from re-interpretation of current raw field text.
-        Deepcopy of raw fields required to stop to stop them from being changed to interpreted text.
+        Read the PATH instructions of the interpreted fields sourced from paths, safe to call from another thread
+        :returns: list of (Instruction, Instruction.resolve result) tuples for apply_source_updates
         """
-        self.interpreted.refresh_from_sources(copy.deepcopy(self.raw))
-        self.is_interpreted = self.raw.dump() != self.interpreted.dump()
+        deadline = time.monotonic() + memfog.config.interpret_timeout
+        updates = []
+        for field_obj in list(vars(self.interpreted).values()):
+            for instruction in list(field_obj.instructions):
+                if instruction.key == 'PATH' and instruction.val in paths:
+                    updates.append((instruction, instruction.resolve(deadline, self.cache, use_cache=False)))
+        return updates
+
+    def apply_source_updates(self, updates):
+        """
+        Set the text of instructions to the text read by read_sources and splice it into the interpreted fields
+        holding them. Fields whose interpreted text the user edited are left as they are.
+        :returns: set of the names of the fields changed
+        """
+        timeout = memfog.config.interpret_timeout
+        changed = set()
+        for field_name, field_obj in vars(self.interpreted).items():
+            if not field_obj.is_interpreted() or field_obj.text != field_obj.interpretation:
+                continue
+            field_updates = [ (instruction, result) for instruction, result in updates
+                              if any(instruction is own for own in field_obj.instructions) ]
+            for instruction, (stamp, text, partial) in field_updates:
+                instruction.stamp, instruction.text, instruction.partial = stamp, text, partial
+            if len(field_updates) > 0:
+                field_obj.text = field_obj.interpretation = Interpreted.splice(field_obj, timeout)
+                changed.add(field_name)
+        return changed
 
     def update_interpreted_sources(self):
         """ Write changes made to interpreted PATH text to their source file """
-        for field_name, field_obj in vars(self.interpreted).items():
-            for instruction_key, instruction_val in field_obj.instructions:
-                if instruction_key == 'PATH':
-                    file_io.str_to_file(instruction_val, field_obj.text)
+        self.write_sources(self.interpreted_source_writes())
+
+    def interpreted_source_writes(self):
+        """ :returns: list of (path, text) writes update_interpreted_sources makes, to make them later elsewhere """
+        return [ (instruction.val, field_obj.text) for field_obj in vars(self.interpreted).values()
+                 for instruction in field_obj.instructions if instruction.key == 'PATH' and not instruction.partial ]
+
+    @staticmethod
+    def write_sources(writes):
+        for fp, text in writes:
+            file_io.str_to_file(fp, text)
 
     def update_record_context(self, context):
         """
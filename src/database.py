@@ -1,44 +1,375 @@
-from sqlalchemy import Column, Integer, String, Text, create_engine
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, Text, and_, create_engine, event, or_, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+import datetime
+
+from . import util
 
 Base = declarative_base()
 
+# Maximum number of values bound to a single IN clause, older sqlite versions allow no more than 999 variables
+IN_CLAUSE_SIZE = 500
+
+# Number of leading characters a query token shares with an indexed token for them to be considered near
+NEAR_PREFIX_LEN = 3
+
+
+def utc_now():
+    """ :returns: naive datetime of the current UTC time, as stored in the created/modified/deleted columns """
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def make_token_set(title, keywords):
+    """
+    :returns: set of standardized tokens used to index a record, body text is not indexed
+    """
+    text = ' '.join([title or '', keywords or ''])
+    try:
+        return set(util.standardize(text))
+    except ValueError:
+        # tokenize raises on unbalanced quotes, index the whitespace separated words instead
+        return set(util.strip_punctuation(text).lower().split())
+
+def make_tokens(title, keywords):
+    """
+    :returns: normalized, sorted token string stored in the tokens column of a record
+    """
+    return ' '.join(sorted(make_token_set(title, keywords)))
+
+def make_tokens_many(pairs):
+    """
+    :type pairs: list of (title, keywords) tuples
+    :returns: make_tokens of each pair, tokenized in a single batch
+    """
+    texts = [ ' '.join([title or '', keywords or '']) for title, keywords in pairs ]
+    try:
+        return [ ' '.join(sorted(set(tokens))) for tokens in util.standardize_many(texts) ]
+    except ValueError:
+        # Some text has unbalanced quotes, let make_token_set handle each pair individually
+        return [ make_tokens(title, keywords) for title, keywords in pairs ]
+
+# FTS5 external content table mirroring the title, keywords and body columns of the record table.
+# Triggers keep it in sync with every insert, update and delete made to the record table.
+FTS_SCHEMA = [
+    """CREATE VIRTUAL TABLE record_fts USING fts5(
+           title, keywords, body, content='record', content_rowid='row_id')""",
+    """CREATE TRIGGER record_fts_ai AFTER INSERT ON record BEGIN
+           INSERT INTO record_fts(rowid, title, keywords, body)
+           VALUES (new.row_id, new.title, new.keywords, new.body);
+       END""",
+    """CREATE TRIGGER record_fts_ad AFTER DELETE ON record BEGIN
+           INSERT INTO record_fts(record_fts, rowid, title, keywords, body)
+           VALUES ('delete', old.row_id, old.title, old.keywords, old.body);
+       END""",
+    """CREATE TRIGGER record_fts_au AFTER UPDATE ON record BEGIN
+           INSERT INTO record_fts(record_fts, rowid, title, keywords, body)
+           VALUES ('delete', old.row_id, old.title, old.keywords, old.body);
+           INSERT INTO record_fts(rowid, title, keywords, body)
+           VALUES (new.row_id, new.title, new.keywords, new.body);
+       END""",
+    """INSERT INTO record_fts(record_fts) VALUES ('rebuild')"""
+]
+
+
+def fts_query(tokens):
+    """
+    :type tokens: iterable of standardized tokens
+    :returns: FTS5 MATCH expression matching any token as a prefix
+    """
+    return ' OR '.join('"{}"*'.format(token.replace('"', '""')) for token in tokens)
+
 class Database:
-    def __init__(self, db_fp):
+    def __init__(self, db_fp, fts=False, pragmas=None):
+        """
+        :param fts: maintain the record_fts full text index used for BM25 ranked searches
+        :param pragmas: dict of sqlite pragma name to value applied to every connection
+        """
         # Create an engine that stores data in db found at db_path
         engine = create_engine('sqlite:///{}'.format(db_fp))
+        self.engine = engine
+
+        if pragmas:
+            @event.listens_for(engine, 'connect')
+            def apply_pragmas(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                for name, value in pragmas.items():
+                    cursor.execute('PRAGMA {} = {}'.format(name, value))
+                cursor.close()
 
         # Create all tables in the engine
         Base.metadata.create_all(engine)
+        self.migrate(engine)
+
+        self.fts_enabled = fts and self.init_fts(engine)
 
-        DBSession = sessionmaker(bind=engine)
+        # The UI edits records loaded by the reading session, which must never write them back itself.
+        # Committed records stay loaded so records handed between the UI and the writer never lazy load.
+        DBSession = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
         self.session = DBSession()
 
-    def bulk_insert(self, context):
-        self.session.bulk_save_objects(context.record)
+        # Databases created before the token index existed need it populated from their records
+        if self.session.query(TokenMap).first() is None and self.session.query(RecordMap).first() is not None:
+            self.reindex()
+
+    def commit(self):
         self.session.commit()
+        # Detach committed records so later edits made to them by the UI aren't flushed by this session
+        self.session.expunge_all()
+
+    def rollback(self):
+        self.session.rollback()
+
+    def optimize(self):
+        """ Let sqlite refresh the query planner statistics it judges stale """
+        with self.engine.begin() as conn:
+            conn.execute(text('PRAGMA optimize'))
+
+    def bulk_insert(self, context, commit=True):
+        """ Insert the records dumped in context.record, skipping any whose title already exists """
+        self.bulk_write(context.record, overwrite=False)
+        if commit:
+            self.commit()
+
+    def bulk_upsert(self, context, commit=True):
+        """ Insert the records dumped in context.record, replacing any existing record with the same title """
+        self.bulk_write(context.record, overwrite=True)
+        if commit:
+            self.commit()
+
+    def bulk_write(self, dumps, overwrite):
+        """
+        :type dumps: list of dicts returned by Record.dump
+        :param overwrite: update existing records with the same title rather than leaving them as they are
+        """
+        now = utc_now()
+        all_tokens = make_tokens_many([ (dump['title'], dump['keywords']) for dump in dumps ])
+        rows = [ {**dump, 'tokens':tokens, 'created':now, 'modified':now} for dump, tokens in zip(dumps, all_tokens) ]
+
+        statement = sqlite_insert(RecordMap.__table__)
+        if overwrite:
+            # created is left as it is so an overwritten record keeps the time it was first added
+            statement = statement.on_conflict_do_update(
+                index_elements=['title'],
+                set_={ name:statement.excluded[name] for name in ('keywords', 'body', 'tokens', 'modified') })
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=['title'])
+        self.session.execute(statement, rows)
 
-    def insert(self, context):
+        # Reindexing records left unchanged by the conflict clause is harmless, so index every title written
+        for titles in util.chunked([ row['title'] for row in rows ], IN_CLAUSE_SIZE):
+            for row_id, tokens in self.session.query(RecordMap.row_id, RecordMap.tokens).filter(RecordMap.title.in_(titles)):
+                self.index_record(row_id, tokens)
+
+    def bulk_delete(self, context, commit=True):
+        """ Delete the records with a title in the list context.record, leaving a tombstone for each """
+        for titles in util.chunked(context.record, IN_CLAUSE_SIZE):
+            row_ids = [ row_id for row_id, in self.session.query(RecordMap.row_id).filter(RecordMap.title.in_(titles)) ]
+            self.session.query(TokenMap).filter(TokenMap.row_id.in_(row_ids)).delete(synchronize_session=False)
+            self.session.query(RecordMap).filter(RecordMap.row_id.in_(row_ids)).delete(synchronize_session=False)
+            self.add_tombstones(titles)
+        if commit:
+            self.commit()
+
+    def add_tombstones(self, titles):
+        """ Record that titles were deleted now, so delta exports can pass deletions on """
+        now = utc_now()
+        statement = sqlite_insert(TombstoneMap.__table__)
+        statement = statement.on_conflict_do_update(index_elements=['title'], set_={'deleted':statement.excluded.deleted})
+        self.session.execute(statement, [ {'title':title, 'deleted':now} for title in titles ])
+
+    def existing_titles(self, titles):
+        """ :returns: set of the titles in titles that a record already has """
+        existing = set()
+        for chunk in util.chunked(titles, IN_CLAUSE_SIZE):
+            existing.update(title for title, in self.session.query(RecordMap.title).filter(RecordMap.title.in_(chunk)))
+        return existing
+
+    def insert(self, context, commit=True):
+        context.record.created = context.record.modified = utc_now()
+        context.record.tokens = make_tokens(context.record.title, context.record.keywords)
         self.session.add(context.record)
-        self.session.commit()
+        # Flush so the row_id of the new record is available to the token index
+        self.session.flush()
+        self.index_record(context.record.row_id, context.record.tokens)
+        if commit:
+            self.commit()
 
-    def delete(self, context):
+    def delete(self, context, commit=True):
+        title = self.session.query(RecordMap.title).filter_by(row_id=context.record.row_id).scalar()
+        if title is not None:
+            self.add_tombstones([title])
+        self.session.query(TokenMap).filter_by(row_id=context.record.row_id).delete()
         self.session.query(RecordMap).filter_by(row_id=context.record.row_id).delete()
-        self.session.commit()
+        if commit:
+            self.commit()
 
-    def update(self, context):
+    def update(self, context, commit=True):
         fields = { k:v for k,v in vars(context.record).items() if k in context.altered_fields }
         if len(fields) > 0:
+            if 'title' in fields:
+                # A renamed record is deleted under its old title as far as delta exports are concerned
+                old_title = self.session.query(RecordMap.title).filter_by(row_id=context.record.row_id).scalar()
+                if old_title is not None and old_title != fields['title']:
+                    self.add_tombstones([old_title])
+            if 'title' in fields or 'keywords' in fields:
+                fields['tokens'] = context.record.tokens = make_tokens(context.record.title, context.record.keywords)
+                self.index_record(context.record.row_id, fields['tokens'])
+            fields['modified'] = context.record.modified = utc_now()
             self.session.query(RecordMap).filter_by(row_id=context.record.row_id).update(fields)
-            self.session.commit()
+            if commit:
+                self.commit()
+
+    def index_record(self, row_id, tokens):
+        """ Replace the token postings for record row_id with the space separated tokens """
+        self.session.query(TokenMap).filter_by(row_id=row_id).delete()
+        postings = [ {'token':token, 'row_id':row_id} for token in (tokens or '').split() ]
+        self.session.bulk_insert_mappings(TokenMap, postings)
+
+    def reindex(self):
+        """ Rebuild the token index from every record in the database """
+        self.session.query(TokenMap).delete()
+        rows = self.session.query(RecordMap.row_id, RecordMap.title, RecordMap.keywords, RecordMap.tokens).all()
+        for row_id, title, keywords, tokens in rows:
+            if tokens is None:
+                # Left without tokens by a migration interrupted before it was applied in a single transaction
+                tokens = make_tokens(title, keywords)
+                self.session.query(RecordMap).filter_by(row_id=row_id).update({'tokens':tokens})
+            postings = [ {'token':token, 'row_id':row_id} for token in tokens.split() ]
+            self.session.bulk_insert_mappings(TokenMap, postings)
+        self.session.commit()
+
+    @staticmethod
+    def migrate(engine):
+        """
+        Add columns and indexes introduced after a database was created to its record table.
+        Everything is applied in one transaction, so a migration that is interrupted is applied again in full.
+        """
+        with engine.begin() as conn:
+            # pysqlite only opens a transaction before DML, ALTER TABLE would otherwise be committed on its own
+            conn.exec_driver_sql('BEGIN')
+            columns = { row[1] for row in conn.execute(text('PRAGMA table_info(record)')) }
+            if 'tokens' not in columns:
+                conn.execute(text('ALTER TABLE record ADD COLUMN tokens VARCHAR'))
+                Database.fill_tokens(conn)
+            if 'modified' not in columns:
+                conn.execute(text('ALTER TABLE record ADD COLUMN created DATETIME'))
+                conn.execute(text('ALTER TABLE record ADD COLUMN modified DATETIME'))
+                conn.execute(text('CREATE INDEX ix_record_modified ON record (modified)'))
+                # When existing records were written is unknown, treat them as written now so the next delta
+                # export includes them
+                conn.execute(
+                    text('UPDATE record SET created = :now, modified = :now'),
+                    {'now':utc_now().strftime('%Y-%m-%d %H:%M:%S.%f')})
+
+            indexes = { row[1] for row in conn.execute(text('PRAGMA index_list(record)')) }
+            if 'ix_record_title' not in indexes:
+                # Titles must be unique before the index can be created. The most recently added record keeps a
+                # duplicated title, the others are renamed rather than dropped
+                duplicates = conn.execute(text(
+                    'SELECT row_id, title, keywords FROM record '
+                    'WHERE row_id NOT IN (SELECT MAX(row_id) FROM record GROUP BY title) ORDER BY row_id')).all()
+                if len(duplicates) > 0:
+                    Database.rename_duplicates(conn, duplicates)
+                conn.execute(text('CREATE UNIQUE INDEX ix_record_title ON record (title)'))
+
+    @staticmethod
+    def fill_tokens(conn):
+        """ Compute the tokens column of every record, written before the column existed """
+        rows = conn.execute(text('SELECT row_id, title, keywords FROM record')).all()
+        all_tokens = make_tokens_many([ (title, keywords) for row_id, title, keywords in rows ])
+        if len(rows) > 0:
+            conn.execute(
+                text('UPDATE record SET tokens = :tokens WHERE row_id = :row_id'),
+                [ {'tokens':tokens, 'row_id':row_id} for (row_id, title, keywords), tokens in zip(rows, all_tokens) ])
+        # Postings indexed before the tokens column existed are rebuilt from it by reindex once the database opens
+        conn.execute(text('DELETE FROM token'))
+
+    @staticmethod
+    def rename_duplicates(conn, duplicates):
+        """
+        Give each record in duplicates a title no other record has by adding a numeric suffix, 'title (2)'
+        :param duplicates: list of (row_id, title, keywords) rows
+        """
+        titles = { title for title, in conn.execute(text('SELECT title FROM record')) }
+        # Databases predating the token index have theirs built from scratch once opened
+        indexed = conn.execute(text('SELECT 1 FROM token LIMIT 1')).first() is not None
+        now = utc_now().strftime('%Y-%m-%d %H:%M:%S.%f')
+
+        for row_id, title, keywords in duplicates:
+            n = 2
+            while '{} ({})'.format(title, n) in titles:
+                n += 1
+            new_title = '{} ({})'.format(title, n)
+            titles.add(new_title)
+
+            tokens = make_tokens(new_title, keywords)
+            conn.execute(
+                text('UPDATE record SET title = :title, tokens = :tokens, modified = :now WHERE row_id = :row_id'),
+                {'title':new_title, 'tokens':tokens, 'now':now, 'row_id':row_id})
+            if indexed:
+                conn.execute(text('DELETE FROM token WHERE row_id = :row_id'), {'row_id':row_id})
+                conn.execute(
+                    text('INSERT INTO token (token, row_id) VALUES (:token, :row_id)'),
+                    [ {'token':token, 'row_id':row_id} for token in tokens.split() ])
+            print('Renamed duplicate record \'{}\' to \'{}\''.format(title, new_title))
+
+    @staticmethod
+    def init_fts(engine):
+        """
+        Create the record_fts table and its triggers unless they already exist
+        :returns: True if the sqlite library supports FTS5
+        """
+        with engine.begin() as conn:
+            exists = conn.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name='record_fts'")).first()
+            if exists is None:
+                try:
+                    for statement in FTS_SCHEMA:
+                        conn.execute(text(statement))
+                except OperationalError:
+                    return False
+        return True
+
+    def fts_search(self, tokens, weights, limit):
+        """
+        :param weights: BM25 weight of the title, keywords and body columns
+        :param limit: maximum number of results, negative for no limit
+        :returns: list of (row_id, bm25 rank) tuples sorted from best to worst match
+        """
+        statement = text(
+            'SELECT rowid, bm25(record_fts, :title_w, :keywords_w, :body_w) AS rank '
+            'FROM record_fts WHERE record_fts MATCH :query ORDER BY rank LIMIT :limit')
+        params = {
+            'title_w':weights[0], 'keywords_w':weights[1], 'body_w':weights[2],
+            'query':fts_query(tokens), 'limit':limit
+        }
+        return [ tuple(row) for row in self.session.execute(statement, params) ]
+
+    def candidate_ids(self, tokens):
+        """
+        :type tokens: iterable of standardized tokens
+        :returns: query selecting row_id of each record indexed under a token equal or near to any of tokens
+        """
+        clauses = []
+        for token in tokens:
+            # Range comparison on the token prefix lets sqlite use the primary key index, unlike LIKE
+            prefix = token[:NEAR_PREFIX_LEN]
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            clauses.append(and_(TokenMap.token >= prefix, TokenMap.token < upper))
+        return self.session.query(TokenMap.row_id).filter(or_(*clauses)).distinct()
 
 class RecordMap(Base):
     __tablename__ = 'record'
     row_id = Column('row_id', Integer, primary_key=True)
-    title = Column('title', String, nullable=False)
+    title = Column('title', String, nullable=False, unique=True, index=True)
     keywords = Column('keywords', String)
     body = Column('body', Text)
+    # Normalized, sorted title and keyword tokens computed on write so searches don't re-tokenize every record
+    tokens = Column('tokens', String)
+    # UTC times, modified is indexed so delta exports only read records changed since the last one
+    created = Column('created', DateTime)
+    modified = Column('modified', DateTime, index=True)
 
     def __init__(self, row_id=None, title='', keywords='', body=''):
         self.row_id = row_id
@@ -46,3 +377,14 @@ class RecordMap(Base):
         self.keywords = keywords
         self.body = body
 
+class TokenMap(Base):
+    """ Inverted index posting, maps a standardized title/keyword token to a record containing it """
+    __tablename__ = 'token'
+    token = Column('token', String, primary_key=True)
+    row_id = Column('row_id', Integer, ForeignKey('record.row_id'), primary_key=True, index=True)
+
+class TombstoneMap(Base):
+    """ Title of a deleted record and the UTC time it was deleted, kept so delta exports include deletions """
+    __tablename__ = 'tombstone'
+    title = Column('title', String, primary_key=True)
+    deleted = Column('deleted', DateTime, nullable=False, index=True)
@@ -1,24 +1,118 @@
+import gzip
 import json
+import lzma
+import mmap
+import os
 
 from . import memfog
 from . import file_sys
 
 
-def json_from_file(fp):
+# Compression used for files with these extensions
+COMPRESSED_OPENERS = { '.gz':gzip.open, '.xz':lzma.open, '.lzma':lzma.open }
+
+
+def open_file(fp, mode):
+    """
+    Open fp in text mode, transparently compressing or decompressing it if its extension is in COMPRESSED_OPENERS
+    :param mode: 'r' or 'w'
+    """
+    for extension, opener in COMPRESSED_OPENERS.items():
+        if str(fp).endswith(extension):
+            return opener(str(fp), mode + 't')
+    return open(str(fp), mode)
+
+def is_json_lines(fp):
+    """ :returns: True if fp is a json lines file, ignoring any compression extension """
+    name = str(fp)
+    for extension in COMPRESSED_OPENERS:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return name.endswith('.jsonl')
+
+def json_stream_from_file(fp, chunk_size=65536):
     """
+    Incrementally decode the objects in a json array file, or a json lines file if fp ends with .jsonl,
+    without reading the whole file into memory. Compressed files are decompressed while reading.
     :type fp: pathlib.Path or str
+    :returns: generator of decoded objects
+    :raises OSError: if fp can't be read
+    :raises ValueError: if fp contains invalid json
     """
     fp = file_sys.Path(fp)
 
     if len(fp.parts) == 1:
         fp = memfog.config.project_dp + fp
-    try:
-        if fp.exists():
-            with open(str(fp), 'r') as f:
-                return json.load(f)
-        return dict()
-    except Exception as e:
-        return 'Error occured while reading {} as json\n{}'.format(str(fp), e.args)
+
+    with open_file(fp, 'r') as f:
+        if is_json_lines(fp):
+            for line in f:
+                if len(line.strip()) > 0:
+                    yield json.loads(line)
+        else:
+            yield from _json_array_stream(f, chunk_size)
+
+def _json_array_stream(f, chunk_size):
+    """ Decode each element of the json array in file object f as soon as enough of it has been read """
+    decoder = json.JSONDecoder()
+    buf = f.read(chunk_size).lstrip()
+
+    if not buf.startswith('['):
+        raise ValueError('Expected a json array')
+    buf = buf[1:]
+
+    while True:
+        # Skip separators up to the start of the next element
+        buf = buf.lstrip().lstrip(',').lstrip()
+
+        if buf.startswith(']'):
+            return
+
+        try:
+            obj, end = decoder.raw_decode(buf)
+        except ValueError:
+            chunk = f.read(max(chunk_size, len(buf)))
+            if len(chunk) == 0:
+                raise
+            # The element continues past the end of buf, retry once more of the file has been read
+            buf += chunk
+            continue
+
+        yield obj
+        buf = buf[end:]
+
+        if len(buf) < chunk_size:
+            buf += f.read(chunk_size)
+
+def json_stream_to_file(fp, objects):
+    """
+    Incrementally write objects as a json array formatted like json_to_file, or one object per line if fp ends
+    with .jsonl. Compressed if the extension of fp is in COMPRESSED_OPENERS.
+    :type fp: pathlib.Path or str
+    :type objects: iterable of json encodable objects
+    :returns: number of objects written
+    :raises OSError: if fp can't be written
+    """
+    fp = file_sys.Path(fp)
+
+    if len(fp.parts) == 1:
+        fp = memfog.config.project_dp + fp
+
+    count = 0
+    with open_file(fp, 'w') as f:
+        if is_json_lines(fp):
+            for obj in objects:
+                f.write(json.dumps(obj))
+                f.write('\n')
+                count += 1
+        else:
+            for obj in objects:
+                # json escapes newlines within strings so every newline in the dump separates lines
+                f.write(',\n    ' if count > 0 else '[\n    ')
+                f.write(json.dumps(obj, indent=4).replace('\n', '\n    '))
+                count += 1
+            f.write('\n]' if count > 0 else '[]')
+    return count
 
 def json_to_file(fp, content):
     """
@@ -44,7 +138,7 @@ def str_from_file(fp):
     fp = file_sys.Path(fp)
 
     if len(fp.parts) == 1:
-        fp = memfog.config.project_dp / fp
+        fp = memfog.config.project_dp + fp
     try:
         if fp.exists():
             with open(str(fp), 'r') as f:
@@ -53,6 +147,64 @@ def str_from_file(fp):
     except Exception as e:
         return 'Error occured while reading {} as string\n{}'.format(str(fp), e.args)
 
+def str_window_from_file(fp, head=None, tail=None, lines=None, limit=None):
+    """
+    Decode a window of the file at fp. The file is memory mapped, so nothing outside the window is read.
+    :type fp: pathlib.Path or str
+    :param head: number of lines from the start of the file
+    :param tail: number of lines from the end of the file
+    :param lines: (first, last) line numbers, counted from 1 and inclusive
+    :param limit: maximum number of bytes decoded
+    :returns: (text, partial) where partial is True unless text is the whole file
+    """
+    fp = file_sys.Path(fp)
+
+    if len(fp.parts) == 1:
+        fp = memfog.config.project_dp + fp
+    try:
+        if not fp.exists():
+            return str(), False
+        with open(str(fp), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return str(), False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                start, end = 0, size
+                if lines is not None:
+                    start = _line_offset(mm, lines[0] - 1)
+                    end = _line_offset(mm, lines[1] - lines[0] + 1, start)
+                elif head is not None:
+                    end = _line_offset(mm, head)
+                elif tail is not None:
+                    start = _tail_offset(mm, tail)
+                if limit is not None and end - start > limit:
+                    end = start + limit
+                # A window can split a multi-byte character at either end
+                return mm[start:end].decode(errors='replace'), start > 0 or end < size
+    except Exception as e:
+        return 'Error occured while reading {} as string\n{}'.format(str(fp), e.args), True
+
+def _line_offset(mm, n, offset=0):
+    """ :returns: offset of the start of the nth line after offset, end of mm if it has fewer lines """
+    for _ in range(max(n, 0)):
+        i = mm.find(b'\n', offset)
+        if i == -1:
+            return len(mm)
+        offset = i + 1
+    return offset
+
+def _tail_offset(mm, n):
+    """ :returns: offset of the start of the nth line from the end of mm, a trailing newline doesn't end a line """
+    end = len(mm)
+    if mm[end-1:end] == b'\n':
+        end -= 1
+    for _ in range(n):
+        i = mm.rfind(b'\n', 0, end)
+        if i == -1:
+            return 0
+        end = i
+    return end + 1
+
 def str_to_file(fp, content):
     """
     :type fp: pathlib.Path or str
@@ -0,0 +1,50 @@
+from fuzzywuzzy import fuzz, utils as fuzz_utils
+import multiprocessing
+import itertools
+
+from . import util
+
+
+def sort_tokens(s):
+    """ Processed, token sorted form of s that fuzz.token_sort_ratio compares """
+    return ' '.join(sorted(fuzz_utils.full_process(s, force_ascii=True).split()))
+
+def ratio_bound(s1, s2):
+    """
+    :returns: upper bound of fuzz.ratio(s1, s2) from string lengths alone.
+    At most every character of the shorter string can be matched, so ratio <= 2 * min(len) / (len(s1) + len(s2))
+    """
+    if len(s1) == 0 and len(s2) == 0:
+        return 100
+    return int(round(100 * 2.0 * min(len(s1), len(s2)) / (len(s1) + len(s2))))
+
+def score_partition(args):
+    """
+    Score a partition of records against the query, run directly or by a worker of a multiprocessing pool.
+    Equivalent to fuzz.token_sort_ratio with the query processed once rather than once per record.
+    Records are skipped without scoring when their length bound can't beat the current top n records.
+    :param args: tuple of (list of (index, tokens) pairs, token sorted query, n)
+    :returns: list of (score, index) tuples for the top n records of the partition
+    """
+    items, sorted_query, n = args
+    processed = ( (index, sort_tokens(tokens)) for index, tokens in items )
+    top_items = util.top_n(
+        processed, n,
+        score_func=lambda item: fuzz.ratio(item[1], sorted_query),
+        bound_func=lambda item: ratio_bound(item[1], sorted_query)
+    )
+    return [ (score, index) for score, (index, _) in top_items ]
+
+def score_parallel(items, sorted_query, n, jobs):
+    """
+    Partition items across a pool of jobs processes and merge the top n of each partition.
+    Ties are broken by index in the same way as a single score_partition over every item.
+    """
+    size = -(-len(items) // jobs)
+    partitions = [ (items[i:i+size], sorted_query, n) for i in range(0, len(items), size) ]
+
+    with multiprocessing.Pool(jobs) as pool:
+        partial_results = pool.map(score_partition, partitions)
+
+    merged = sorted(itertools.chain.from_iterable(partial_results))
+    return merged[-n:] if n > 0 else merged
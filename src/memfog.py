@@ -1,46 +1,186 @@
-from fuzzywuzzy import fuzz
+from sqlalchemy.orm import load_only
 import multiprocessing
+import threading
+import traceback
+import atexit
 import datetime
+import heapq
+import itertools
+import queue
+import sys
 
-from . import file_io, ui, user, util
+from . import file_io, user, util
 from .record import Record, RecordGroup
-from .database import Database
+from .database import Database, TombstoneMap, utc_now
 from .proxy import Flags
 from .file_sys import Path
 
 
 config = None
 
+# Number of commits made by the writer between each time it runs PRAGMA optimize
+OPTIMIZE_INTERVAL = 100
 
-class ProcessHandler(multiprocessing.Process):
+
+class Handler:
     """ Consumer that handles processing messages put in queue by UI """
-    def __init__(self, q):
-        super(ProcessHandler, self).__init__()
-        self.daemon = True
-        self.db = Database(config.db_fp)
+    def __init__(self, q, acks, db_fp, pragmas, log_fp):
+        """
+        :param acks: queue the outcome of contexts with an ack_id is put in as (ack_id, row_id, saved)
+        :param log_fp: file failures are appended to, stderr belongs to the terminal the UI draws on
+        """
         self.q = q
-
-    def get_db_stream(self):
-        return self.db.session.query(Record)
+        self.acks = acks
+        self.db_fp = db_fp
+        self.pragmas = pragmas
+        self.log_fp = log_fp
 
     def run(self):
+        # Opened by the consumer itself so its connection is never shared with the producer
+        self.db = Database(self.db_fp, pragmas=self.pragmas)
+        commit_count = 0
+
         while True:
             try:
-                context = self.q.get()
+                contexts = [self.q.get()]
             except KeyboardInterrupt:
                 break
 
-            switch = {
-                Flags.INSERTRECORD : self.db.insert,
-                Flags.UPDATERECORD : self.db.update,
-                Flags.DELETERECORD : self.db.delete,
-                Flags.BULKINSERTRECORD : self.db.bulk_insert
-            }
+            # Drain every context already waiting so they are all applied in a single transaction
+            while True:
+                try:
+                    contexts.append(self.q.get_nowait())
+                except queue.Empty:
+                    break
+
+            self.apply(contexts)
+
+            commit_count += 1
+            if commit_count % OPTIMIZE_INTERVAL == 0:
+                self.db.optimize()
+
+            # Notify UI process that each context has been durably committed and it can resume execution
+            for _ in contexts:
+                self.q.task_done()
+
+    def apply(self, contexts):
+        """
+        Apply contexts in one transaction with a single commit.
+        If any context fails, the transaction is rolled back and each context is retried in a transaction of
+        its own so one bad context doesn't prevent the others from being written.
+        """
+        switch = {
+            Flags.INSERTRECORD : self.db.insert,
+            Flags.UPDATERECORD : self.db.update,
+            Flags.DELETERECORD : self.db.delete,
+            Flags.BULKINSERTRECORD : self.db.bulk_insert,
+            Flags.BULKUPSERTRECORD : self.db.bulk_upsert,
+            Flags.BULKDELETERECORD : self.db.bulk_delete
+        }
+
+        try:
+            for context in contexts:
+                switch[context.flag](context, commit=False)
+            self.db.commit()
+            self.acknowledge(contexts, saved=True)
+            return
+        except Exception:
+            self.db.rollback()
+            if len(contexts) == 1:
+                self.report_failure(contexts[0])
+                self.acknowledge(contexts, saved=False)
+                return
+
+        for context in contexts:
+            try:
+                switch[context.flag](context)
+                self.acknowledge([context], saved=True)
+            except Exception:
+                self.db.rollback()
+                self.report_failure(context)
+                self.acknowledge([context], saved=False)
+
+    def acknowledge(self, contexts, saved):
+        """ Tell whoever put contexts with an ack_id whether they were committed and the row_id of their record """
+        for context in contexts:
+            if context.ack_id is not None:
+                row_id = getattr(context.record, 'row_id', None) if saved else None
+                self.acks.put((context.ack_id, row_id, saved))
+
+    def report_failure(self, context):
+        try:
+            with open(str(self.log_fp), 'a') as f:
+                f.write('{} Unable to apply {} to the database\n'.format(utc_now().isoformat(), context.flag.name))
+                traceback.print_exc(file=f)
+        except OSError:
+            pass
+
+
+class ProcessHandler(Handler, multiprocessing.Process):
+    def __init__(self, q, acks, db_fp, pragmas, log_fp):
+        multiprocessing.Process.__init__(self)
+        Handler.__init__(self, q, acks, db_fp, pragmas, log_fp)
+        self.daemon = True
+
 
-            switch[context.flag](context)
+class ThreadHandler(Handler, threading.Thread):
+    def __init__(self, q, acks, db_fp, pragmas, log_fp):
+        threading.Thread.__init__(self)
+        Handler.__init__(self, q, acks, db_fp, pragmas, log_fp)
+        self.daemon = True
+
+
+class WriterQueue:
+    """
+    Queue of messages for a consumer that is only started by the first put, so sessions that never write
+    don't pay for creating it. Provides the put/join interface of multiprocessing.JoinableQueue.
+    """
+    def __init__(self, writer):
+        """
+        :param writer: 'process' to consume messages in a child process, 'thread' for a thread of this process
+        """
+        self.writer = writer
+        self.q = None
+        # Callback and context of each put waiting to be acknowledged, by ack_id
+        self.pending_acks = {}
+        self.ack_count = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        switch = {
+            'process' : (multiprocessing.JoinableQueue, multiprocessing.Queue, ProcessHandler),
+            'thread' : (queue.Queue, queue.Queue, ThreadHandler)
+        }
+        queue_type, ack_queue_type, handler_type = switch[self.writer]
+        self.q = queue_type()
+        self.acks = ack_queue_type()
+        handler_type(self.q, self.acks, config.db_fp, config.sqlite_pragmas, config.writer_log_fp).start()
+        threading.Thread(target=self.dispatch_acks, daemon=True).start()
+
+    def put(self, context, on_ack=None):
+        """
+        :param on_ack: called from a background thread with (context, row_id, saved) once the writer has committed
+                       context or failed to, rather than waiting for it with join
+        """
+        if self.q is None:
+            self.start()
+        if on_ack is not None:
+            with self.lock:
+                self.ack_count += 1
+                context.ack_id = self.ack_count
+                self.pending_acks[context.ack_id] = (context, on_ack)
+        self.q.put(context)
+
+    def dispatch_acks(self):
+        while True:
+            ack_id, row_id, saved = self.acks.get()
+            with self.lock:
+                context, on_ack = self.pending_acks.pop(ack_id)
+            on_ack(context, row_id, saved)
 
-            # Notify UI process that context has been fully processed and it can resume execution
-            self.q.task_done()
+    def join(self):
+        if self.q is not None:
+            self.q.join()
 
 
 class QContext:
@@ -51,29 +191,93 @@ class QContext:
         self.view_mode = v_mode
         self.flag = flag
         self.altered_fields = set()
+        # Set by WriterQueue.put when the sender asks to be told once the context is committed
+        self.ack_id = None
 
 
 class Memfog:
     def __init__(self):
-        self.q = multiprocessing.JoinableQueue()
-        ph = ProcessHandler(self.q)
-        self.record_group = RecordGroup(ph.get_db_stream())
-        ph.start()
+        self.db = Database(config.db_fp, fts=config.scorer == 'fts', pragmas=config.sqlite_pragmas)
+        self.q = WriterQueue(config.writer)
+        atexit.register(self.db.optimize)
+        self._record_group = None
+
+        if config.scorer == 'fts' and not self.db.fts_enabled:
+            print('SQLite FTS5 is unavailable, falling back to fuzzy search')
+            config.scorer = 'fuzzy'
+
+        if config.scorer == 'ngram':
+            from . import ngram
+            if not ngram.available():
+                print('NumPy is not installed, falling back to fuzzy search')
+                config.scorer = 'fuzzy'
+
+    def get_db_stream(self):
+        return self.db.session.query(Record)
+
+    def get_index_stream(self):
+        """
+        Stream of records with only the columns needed for searching loaded.
+        The body column is deferred and only fetched from the database when it is accessed.
+        """
+        return self.get_db_stream().options(load_only(Record.row_id, Record.title, Record.keywords, Record.tokens))
+
+    def get_candidate_stream(self, tokens):
+        """ Stream of records sharing a token, or a token prefix, with tokens """
+        candidate_ids = self.db.candidate_ids(tokens)
+        return self.get_index_stream().filter(Record.row_id.in_(candidate_ids)).order_by(Record.row_id)
+
+    def get_token_stream(self):
+        return self.db.session.query(Record.row_id, Record.tokens).order_by(Record.row_id)
+
+    def get_row_stream(self, row_ids):
+        return self.get_index_stream().filter(Record.row_id.in_(row_ids))
+
+    @property
+    def record_group(self):
+        """ Every record in the database, only loaded once a code path needs the whole store """
+        if self._record_group is None:
+            self._record_group = RecordGroup(self.get_index_stream())
+        return self._record_group
+
+    def record_count(self):
+        return self.get_db_stream().count()
+
+    def search(self, user_input):
+        switch = { 'fuzzy':self.fuzzy_match, 'fts':self.fts_match, 'ngram':self.ngram_match }
+        return switch[config.scorer](user_input)
 
     def create_rec(self):
         context = QContext(Record(), Flags.INSERTRECORD, i_mode='INSERT', v_mode='RAW')
+        # urwid is only imported once a record is actually opened
+        from . import ui
         ui.UI(context, self.q)
 
     def display_rec(self, user_keywords):
-        Rec_fuzz_matches = self.fuzzy_match(user_keywords)
+        Rec_fuzz_matches = self.search(user_keywords)
         record = self.display_rec_list(Rec_fuzz_matches, 'Display')
-
         if record is not None:
-            context = QContext(record, Flags.UPDATERECORD, i_mode='COMMAND', v_mode='INTERPRETED')
-            ui.UI(context, self.q)
+            self.open_rec(record)
+
+    def pick_rec(self, user_keywords):
+        """ Display the record picked from matches ranked as the query, starting with user_keywords, is typed """
+        from . import ui
+        from .token_index import TokenIndex
+
+        rows = self.db.session.query(Record.row_id, Record.title, Record.keywords, Record.tokens)\
+            .order_by(Record.row_id).yield_per(config.export_batch_size)
+        picker = ui.Picker(TokenIndex(rows), user_keywords)
+        if picker.selected is not None:
+            self.open_rec(self.get_index_stream().filter(Record.row_id == picker.selected).one())
+
+    def open_rec(self, record):
+        # Accessing the deferred body column of the record when the UI builds its data fetches it
+        context = QContext(record, Flags.UPDATERECORD, i_mode='COMMAND', v_mode='INTERPRETED')
+        from . import ui
+        ui.UI(context, self.q)
 
     def display_rec_list(self, Rec_fuzz_matches, action_description):
-        if len(self.record_group) > 0:
+        if len(Rec_fuzz_matches) > 0:
             print('{} which record?'.format(action_description))
 
             for i,Rec in enumerate(Rec_fuzz_matches):
@@ -85,16 +289,19 @@ class Memfog:
                 return
 
             if selection is not None:
-                if selection < len(self.record_group):
+                if selection < len(Rec_fuzz_matches):
                     return Rec_fuzz_matches[selection]
                 else:
                     print('Invalid record selection \'{}\''.format(selection))
         else:
-            print('No records exist')
+            print('No matching records')
 
     def export_recs(self, target_path):
         date = datetime.datetime.now()
-        default_fn = Path('memfog_{}-{}-{}.json'.format(date.month, date.day, date.year))
+        if config.export_since is None:
+            default_fn = Path('memfog_{}-{}-{}.json'.format(date.month, date.day, date.year))
+        else:
+            default_fn = Path('memfog_delta_{:%Y%m%d-%H%M%S}.json'.format(date))
 
         if target_path is None:
             target_path = config.project_dp + default_fn
@@ -108,47 +315,205 @@ class Memfog:
             if not user.prompt_yn('Overwrite existing file {}'.format(str(target_path))):
                 return
 
-        rec_backups = [ Rec.dump() for Rec in self.record_group ]
-        file_io.json_to_file(target_path, rec_backups)
-        print('Exported to ' + str(target_path))
+        # Taken before reading so changes made while exporting are included again by the next delta export
+        export_started = utc_now()
+
+        if config.export_since is None:
+            # Rows are read and written in batches so the store is never held in memory as a whole
+            rows = self.db.session.query(Record.title, Record.keywords, Record.body).yield_per(config.export_batch_size)
+            rec_backups = ( {'title':title, 'keywords':keywords, 'body':body} for title, keywords, body in rows )
+        else:
+            rec_backups = self.get_delta_stream(config.export_since)
+
+        try:
+            count = file_io.json_stream_to_file(target_path, rec_backups)
+        except OSError as e:
+            print('Unable to write json to {}\n{}'.format(str(target_path), e.args))
+            return
+
+        file_io.str_to_file(config.export_watermark_fp, export_started.isoformat())
+        print('Exported {} to {}'.format(count, str(target_path)))
+
+    def get_delta_stream(self, since):
+        """
+        :type since: datetime.datetime in UTC
+        :returns: generator of the records modified and the titles deleted at or after since, ordered by when the
+                  change was made so applying them in order reproduces the changes. Modified records carry a
+                  modified time, deletions are dicts of title and deleted time.
+        """
+        rows = self.db.session.query(Record.title, Record.keywords, Record.body, Record.modified)\
+            .filter(Record.modified >= since).order_by(Record.modified).yield_per(config.export_batch_size)
+        tombstones = self.db.session.query(TombstoneMap.title, TombstoneMap.deleted)\
+            .filter(TombstoneMap.deleted >= since).order_by(TombstoneMap.deleted).yield_per(config.export_batch_size)
+
+        changes = heapq.merge(
+            ( (modified, {'title':title, 'keywords':keywords, 'body':body, 'modified':modified.isoformat()})
+              for title, keywords, body, modified in rows ),
+            ( (deleted, {'title':title, 'deleted':deleted.isoformat()}) for title, deleted in tombstones ),
+            key=lambda change: change[0])
+        return ( change for time, change in changes )
 
     def fuzzy_match(self, user_input):
-        user_keywords = ' '.join(util.unique_everseen(util.standardize(user_input)))
-        for record in self.record_group:
-            keywords = ' '.join(record.make_set())
-            record.search_score = fuzz.token_sort_ratio(keywords, user_keywords)
-        return [*sorted(self.record_group)][-config.top_n::]
-
-    def import_recs(self, fp):
-        imported_records = file_io.json_from_file(fp)
+        from .fuzzy import sort_tokens, score_partition, score_parallel
+
+        user_tokens = [*util.unique_everseen(util.standardize(user_input))]
+        user_keywords = ' '.join(user_tokens)
+
+        # Only score records sharing a token with the query, fall back to scoring every record if none do
+        records = [*self.get_candidate_stream(user_tokens)] if len(user_tokens) > 0 else []
+        if len(records) == 0:
+            records = [*self.record_group]
+
+        sorted_keywords = sort_tokens(user_keywords)
+        items = [ (i, record.get_tokens()) for i, record in enumerate(records) ]
+
+        # Forking a pool only pays off once there are enough records to outweigh its startup cost
+        if config.jobs > 1 and len(items) >= config.parallel_threshold:
+            top_items = score_parallel(items, sorted_keywords, config.top_n, config.jobs)
+        else:
+            top_items = score_partition((items, sorted_keywords, config.top_n))
+
+        top_records = []
+        for score, index in top_items:
+            records[index].search_score = score
+            top_records.append(records[index])
+        return top_records
+
+    def fts_match(self, user_input):
+        """ Rank records by BM25 across title, keywords and body using the sqlite full text index """
+        user_tokens = [*util.unique_everseen(util.standardize(user_input))]
+        if len(user_tokens) == 0:
+            return []
+
+        # sqlite treats a negative limit as no limit, matching a top_n of 0 returning every record
+        ranks = dict(self.db.fts_search(user_tokens, config.fts_weights, config.top_n or -1))
+        if len(ranks) == 0:
+            return []
+
+        # bm25 ranks are negative with the best match being the lowest, scale relative to the best match
+        best_rank = min(ranks.values()) or -1
+        records = [*self.get_row_stream(ranks.keys())]
+        for record in records:
+            record.search_score = round(100 * ranks[record.row_id] / best_rank)
+        return sorted(records, key=lambda record: ranks[record.row_id], reverse=True)
+
+    def ngram_match(self, user_input):
+        """ Rank records by cosine similarity of hashed character trigram vectors of their title and keywords """
+        from . import ngram
+        user_tokens = ' '.join(util.unique_everseen(util.standardize(user_input)))
+
+        # Only rows of records changed since the cached matrix was written are recomputed
+        index = ngram.NgramIndex(Path(config.data_dp, 'ngram.npz'))
+        if index.update( (row_id, tokens or '') for row_id, tokens in self.get_token_stream() ):
+            index.save()
+
+        top_ids = index.top_n(user_tokens, config.top_n)
+        records = { record.row_id:record for record in self.get_row_stream([ row_id for _, row_id in top_ids ]) }
+
+        top_records = []
+        for score, row_id in top_ids:
+            records[row_id].search_score = score
+            top_records.append(records[row_id])
+        return top_records
+
+    @staticmethod
+    def import_flag(entry):
+        """
+        Deletions and records from a delta export are always applied, other records with a title that already
+        exists are left as they are by the database unless forced
+        """
+        if 'deleted' in entry:
+            return Flags.BULKDELETERECORD
+        if 'modified' in entry or config.force_import:
+            return Flags.BULKUPSERTRECORD
+        return Flags.BULKINSERTRECORD
+
+    @staticmethod
+    def clear_progress(progress):
+        """
+        Blank the progress line so the next line printed isn't written over what is left of it
+        :returns: the empty progress line
+        """
+        if len(progress) > 0:
+            print('\r{}\r'.format(' ' * len(progress)), end='')
+        return ''
+
+    def import_recs(self, fps):
+        """
+        :param fps: files imported in order, such as a full export followed by the delta exports made after it
+        """
+        imported_count = 0
+        deleted_count = 0
         skipped_imports = 0
-        new_records = []
+        # Progress is redrawn in place, which only makes sense on a terminal
+        show_progress = sys.stdout.isatty()
+        progress = ''
 
-        for kwargs in imported_records:
-            if kwargs['title'] not in self.record_group or config.force_import:
-                new_records.append(Record(**kwargs))
-            else:
-                skipped_imports += 1
-                print('Skipping duplicate - {}'.format(kwargs['title']))
+        for fp in fps:
+            try:
+                entries = file_io.json_stream_from_file(fp)
+                # Runs of the same kind of change are batched, the order between runs is kept so a record deleted
+                # and re-added by a delta ends up re-added
+                for flag, run in itertools.groupby(entries, key=self.import_flag):
+                    for batch in util.chunked(run, config.import_batch_size):
+                        # Wait for the writer to finish the previous batch before sending this one, so no more than
+                        # two batches are held in memory while the next one is parsed
+                        self.q.join()
+
+                        if flag is Flags.BULKDELETERECORD:
+                            self.q.put(QContext([ entry['title'] for entry in batch ], flag=flag))
+                            deleted_count += len(batch)
+                            continue
+
+                        new_records = [
+                            Record(title=entry['title'], keywords=entry.get('keywords', ''), body=entry.get('body', '')).dump()
+                            for entry in batch ]
+
+                        if flag is Flags.BULKINSERTRECORD:
+                            # Duplicates are only looked up to report them, the database skips them regardless
+                            existing = self.db.existing_titles([ dump['title'] for dump in new_records ])
+                            unique_records = []
+                            for dump in new_records:
+                                if dump['title'] in existing:
+                                    skipped_imports += 1
+                                    progress = self.clear_progress(progress)
+                                    print('Skipping duplicate - {}'.format(dump['title']))
+                                else:
+                                    existing.add(dump['title'])
+                                    unique_records.append(dump)
+                            new_records = unique_records
+
+                        if len(new_records) > 0:
+                            self.q.put(QContext(new_records, flag=flag))
+                            imported_count += len(new_records)
+                            if show_progress:
+                                progress = 'Importing... {}'.format(imported_count)
+                                print('\r' + progress, end='', flush=True)
+            except (OSError, ValueError, KeyError) as e:
+                progress = self.clear_progress(progress)
+                print('Error occured while reading {} as json\n{}'.format(fp, e.args))
+                break
 
-        if len(new_records) > 0:
-            context = QContext(new_records, flag=Flags.BULKINSERTRECORD)
-            self.q.put(context)
-            self.q.join()
+        self.q.join()
 
+        self.clear_progress(progress)
+
+        summary = 'Imported {}'.format(imported_count)
+        if deleted_count > 0:
+            summary += ', Deleted {}'.format(deleted_count)
         if skipped_imports > 0:
-            print('Imported {}, Skipped {}'.format(len(imported_records) - skipped_imports, skipped_imports))
-        else:
-            print('Imported {}'.format(len(imported_records) - skipped_imports))
+            summary += ', Skipped {}'.format(skipped_imports)
+        print(summary)
 
     def remove_rec(self, user_input):
-        Rec_fuzz_matches = self.fuzzy_match(user_input)
+        Rec_fuzz_matches = self.search(user_input)
         record = self.display_rec_list(Rec_fuzz_matches, 'Remove')
 
         if record is not None and user.prompt_yn('Delete {}'.format(record.title)):
             context = QContext(record, flag=Flags.DELETERECORD)
             self.q.put(context)
             self.q.join()
-            del self.record_group[record.title]
+            if self._record_group is not None:
+                del self.record_group[record.title]
             Rec_fuzz_matches.remove(record)
 
@@ -0,0 +1,143 @@
+import os
+import zipfile
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Number of buckets character trigrams are hashed into
+DIMENSIONS = 2**18
+
+
+def available():
+    return np is not None
+
+def trigram_buckets(tokens):
+    """
+    :param tokens: space separated standardized tokens
+    :returns: dict of hashed trigram bucket to trigram count. Each token is padded with spaces so its
+              first and last characters form their own trigrams.
+    """
+    buckets = {}
+    for token in tokens.split():
+        padded = ' {} '.format(token).encode()
+        for i in range(len(padded) - 2):
+            # crc32 rather than hash() so buckets are stable across processes and can be cached on disk
+            bucket = zlib.crc32(padded[i:i+3]) % DIMENSIONS
+            buckets[bucket] = buckets.get(bucket, 0) + 1
+    return buckets
+
+def make_vector(tokens):
+    """
+    :returns: (indices, data) of the L2 normalized trigram vector of tokens
+    """
+    buckets = trigram_buckets(tokens)
+    indices = np.fromiter(buckets.keys(), dtype=np.int32, count=len(buckets))
+    data = np.fromiter(buckets.values(), dtype=np.float32, count=len(buckets))
+    norm = np.sqrt(np.dot(data, data))
+    if norm > 0:
+        data /= norm
+    return indices, data
+
+
+class NgramIndex:
+    """
+    Hashed character trigram vectors of the title and keywords of every record held in one sparse CSR matrix.
+    Scoring a query against every record is a single sparse matrix-vector product of cosine similarities.
+    The matrix is cached on disk and only rows of records whose tokens changed are recomputed.
+    """
+    def __init__(self, cache_fp):
+        self.cache_fp = str(cache_fp)
+        self.row_ids = np.zeros(0, dtype=np.int64)
+        self.digests = np.zeros(0, dtype=np.uint32)
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.int32)
+        self.data = np.zeros(0, dtype=np.float32)
+        self.load()
+
+    def load(self):
+        try:
+            with np.load(self.cache_fp) as cache:
+                self.row_ids = cache['row_ids']
+                self.digests = cache['digests']
+                self.indptr = cache['indptr']
+                self.indices = cache['indices']
+                self.data = cache['data']
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            # Missing or unreadable cache, every row gets computed by the next update
+            pass
+
+    def save(self):
+        # Written beside the cache then renamed over it, so an interrupted or concurrent save never leaves it
+        # truncated
+        tmp_fp = '{}.{}.tmp'.format(self.cache_fp, os.getpid())
+        try:
+            with open(tmp_fp, 'wb') as f:
+                np.savez(f, row_ids=self.row_ids, digests=self.digests, indptr=self.indptr,
+                         indices=self.indices, data=self.data)
+            os.replace(tmp_fp, self.cache_fp)
+        except BaseException:
+            try:
+                os.remove(tmp_fp)
+            except OSError:
+                pass
+            raise
+
+    def update(self, records):
+        """
+        Bring the matrix in line with records, reusing cached rows of records whose tokens are unchanged
+        :param records: iterable of (row_id, tokens) tuples
+        :returns: True if any row was added, changed or removed
+        """
+        cached = { row_id:i for i, row_id in enumerate(self.row_ids.tolist()) }
+        cached_digests = self.digests.tolist()
+
+        row_ids, digests, rows = [], [], []
+        changed = False
+        for row_id, tokens in records:
+            digest = zlib.crc32(tokens.encode())
+            i = cached.get(row_id)
+            if i is not None and cached_digests[i] == digest:
+                rows.append((self.indices[self.indptr[i]:self.indptr[i+1]], self.data[self.indptr[i]:self.indptr[i+1]]))
+            else:
+                rows.append(make_vector(tokens))
+                changed = True
+            row_ids.append(row_id)
+            digests.append(digest)
+
+        if not changed and len(row_ids) == len(self.row_ids):
+            return False
+
+        self.row_ids = np.array(row_ids, dtype=np.int64)
+        self.digests = np.array(digests, dtype=np.uint32)
+        self.indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        self.indptr[1:] = np.cumsum([ len(indices) for indices, data in rows ])
+        self.indices = np.concatenate([ indices for indices, data in rows ] or [np.zeros(0, dtype=np.int32)])
+        self.data = np.concatenate([ data for indices, data in rows ] or [np.zeros(0, dtype=np.float32)])
+        return True
+
+    def score(self, tokens):
+        """
+        :returns: array of scores from 0 to 100 aligned with self.row_ids
+        """
+        query = np.zeros(DIMENSIONS, dtype=np.float32)
+        indices, data = make_vector(tokens)
+        query[indices] = data
+
+        # Sparse matrix-vector product, each stored value is weighted by the query then summed per row
+        row_of_value = np.repeat(np.arange(len(self.row_ids)), np.diff(self.indptr))
+        similarity = np.bincount(row_of_value, weights=self.data * query[self.indices], minlength=len(self.row_ids))
+        return np.rint(np.clip(similarity, 0, 1) * 100).astype(int)
+
+    def top_n(self, tokens, n):
+        """
+        :returns: list of (score, row_id) tuples of the n best matches sorted by ascending score.
+                  Ties are ordered by position so later records win them, as with the fuzzy scorer.
+        """
+        scores = self.score(tokens)
+        order = np.lexsort((np.arange(len(scores)), scores))
+        if n > 0:
+            order = order[-n:]
+        return [ (int(scores[i]), int(self.row_ids[i])) for i in order ]
@@ -4,4 +4,6 @@ class Flags(enum.Enum):
     INSERTRECORD = 1
     UPDATERECORD = 2
     DELETERECORD = 3
-    BULKINSERTRECORD = 4
\ No newline at end of file
+    BULKINSERTRECORD = 4
+    BULKUPSERTRECORD = 5
+    BULKDELETERECORD = 6
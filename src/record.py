@@ -1,5 +1,4 @@
 from . import database
-from . import util
 
 class Record(database.RecordMap):
     def __init__(self, row_id=None, title='', keywords='', body=''):
@@ -17,8 +16,13 @@ class Record(database.RecordMap):
 
     def make_set(self):
         # body text is not include in string match
-        m_data = ' '.join([self.title, self.keywords])
-        return set(util.standardize(m_data))
+        return database.make_token_set(self.title, self.keywords)
+
+    def get_tokens(self):
+        """ Normalized token string persisted with the record, computed if the record hasn't been written yet """
+        if self.tokens is None:
+            return database.make_tokens(self.title, self.keywords)
+        return self.tokens
 
 class RecordGroup:
     def __init__(self, db_stream):
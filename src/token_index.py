@@ -0,0 +1,114 @@
+import bisect
+import heapq
+import itertools
+
+from . import util
+from .database import make_tokens
+
+# Postings merged or scores compared between each time ranking yields to its caller
+CHUNK_SIZE = 4096
+
+# Number of query tokens whose match weights are kept for the following queries
+WEIGHTS_CACHE_SIZE = 64
+
+
+class TokenIndex:
+    """
+    In memory inverted index of the title and keyword tokens of every record, built once so a query can be
+    ranked again on every keystroke without going back to the database.
+    A query token matches every record token it is a prefix of, the more of the record token it covers the
+    higher the match scores.
+    """
+    def __init__(self, rows):
+        """ :param rows: iterable of (row_id, title, keywords, tokens) tuples ordered by row_id """
+        self.row_ids = []
+        self.titles = []
+        self.postings = {}
+        for position, (row_id, title, keywords, tokens) in enumerate(rows):
+            self.row_ids.append(row_id)
+            self.titles.append(title)
+            for token in set((tokens or make_tokens(title, keywords)).split()):
+                self.postings.setdefault(token, []).append(position)
+        self.vocabulary = sorted(self.postings)
+        # Match weights of recently ranked query tokens, reused while the rest of the query is typed
+        self.weights_cache = {}
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    def prefixed(self, prefix):
+        """ :returns: list of the indexed tokens starting with prefix """
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        end = bisect.bisect_left(self.vocabulary, prefix + '\U0010ffff', start)
+        return self.vocabulary[start:end]
+
+    def token_weights(self, query_token):
+        """
+        Generator yielding between chunks of work
+        :returns: dict of record position to the weight, from 0 to 1, of its best match with query_token
+        """
+        weights = self.weights_cache.get(query_token)
+        if weights is not None:
+            return weights
+
+        weights = {}
+        merged = 0
+        # Longest tokens first so a better match of the same record overwrites a worse one
+        for token in sorted(self.prefixed(query_token), key=len, reverse=True):
+            postings = self.postings[token]
+            weights.update(dict.fromkeys(postings, len(query_token) / len(token)))
+            merged += len(postings)
+            if merged >= CHUNK_SIZE:
+                merged = 0
+                yield
+
+        if len(self.weights_cache) >= WEIGHTS_CACHE_SIZE:
+            self.weights_cache.clear()
+        self.weights_cache[query_token] = weights
+        return weights
+
+    def rank(self, query, n):
+        """
+        Generator yielding between chunks of work, so the caller can spread ranking a query over several calls
+        and drop it as soon as the query is stale
+        :returns: list of (score, row_id, title) tuples of the n best matches, best first. Scores range from 0 to
+                  100 and ties go to the most recently added record. Without query tokens the n most recently
+                  added records are returned.
+        """
+        try:
+            query_tokens = [*util.unique_everseen(util.standardize(query))]
+        except ValueError:
+            # A quoted token is still being typed
+            query_tokens = [*util.unique_everseen(util.standardize(query.replace('\'', ' ').replace('"', ' ')))]
+
+        if len(query_tokens) == 0:
+            positions = range(len(self.row_ids) - 1, max(len(self.row_ids) - n, 0) - 1, -1)
+            return [ (0, self.row_ids[i], self.titles[i]) for i in positions ]
+
+        totals = {}
+        for i, query_token in enumerate(query_tokens):
+            weights = yield from self.token_weights(query_token)
+            if i == 0:
+                totals = dict(weights)
+                continue
+
+            items = iter(weights.items())
+            while True:
+                chunk = [*itertools.islice(items, CHUNK_SIZE)]
+                if len(chunk) == 0:
+                    break
+                for position, weight in chunk:
+                    totals[position] = totals.get(position, 0) + weight
+                yield
+
+        best = []
+        pairs = zip(totals.values(), totals.keys())
+        while True:
+            chunk = [*itertools.islice(pairs, CHUNK_SIZE)]
+            if len(chunk) == 0:
+                break
+            best = heapq.nlargest(n, itertools.chain(best, chunk))
+            yield
+
+        return [ (round(100 * total / len(query_tokens)), self.row_ids[position], self.titles[position])
+                 for total, position in best ]
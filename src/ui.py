@@ -1,12 +1,21 @@
-import urwid.curses_display
+from concurrent.futures import ThreadPoolExecutor
+import urwid.raw_display
 import urwid
+import collections
+import asyncio
+import queue
+import time
 import re
+import os
 
 from . import util
 from . import file_io
 from . import file_sys
+from . import watcher
+from .cache import InterpretationCache
 from .data import Data
 from .proxy import Flags
+from .record import Record
 from . import memfog
 
 
@@ -61,14 +70,118 @@ class KeywordsWidget(urwid.Edit):
         )
 
 
-class BodyWidget(urwid.Edit):
-    def __init__(self):
-        super(BodyWidget, self).__init__(
-            edit_text='',
+class LineWidget(urwid.Edit):
+    """ Editor of a single line of the record body """
+    def __init__(self, walker, line_no):
+        super(LineWidget, self).__init__(
+            edit_text=walker.lines[line_no],
             align='left',
-            multiline=True,
             allow_tab=True
         )
+        self.walker = walker
+        self.line_no = line_no
+
+    def keypress(self, size, key):
+        if key == 'enter':
+            self.walker.split_line(self.line_no, self.edit_pos)
+        elif key == 'backspace' and self.edit_pos == 0 and self.line_no > 0:
+            self.walker.join_lines(self.line_no - 1)
+        elif key == 'delete' and self.edit_pos == len(self.edit_text) and self.line_no < len(self.walker.lines) - 1:
+            self.walker.join_lines(self.line_no)
+        else:
+            key = super(LineWidget, self).keypress(size, key)
+            self.walker.lines[self.line_no] = self.edit_text
+            return key
+
+
+class BodyWalker(urwid.ListWalker):
+    """
+    Rows of the record view, the widgets above the body followed by a LineWidget for each line of the body.
+    Line widgets are only created for lines that are displayed, so drawing, scrolling and editing cost the
+    same whatever the length of the body.
+    """
+    def __init__(self, head):
+        """ :param head: list of widgets shown above the body """
+        self.head = head
+        self.lines = ['']
+        # Line widgets created so far by line number, dropped whenever lines are inserted or removed and
+        # once max_widgets of them have been created, other than the one with the focus
+        self.widgets = {}
+        self.max_widgets = 1000
+        self.focus = 0
+
+    @property
+    def edit_text(self):
+        return '\n'.join(self.lines)
+
+    def set_edit_text(self, text):
+        self.lines = text.split('\n')
+        self.widgets.clear()
+        self.focus = min(self.focus, len(self.head) + len(self.lines) - 1)
+        self._modified()
+
+    def line_widget(self, line_no):
+        widget = self.widgets.get(line_no)
+        if widget is None:
+            if len(self.widgets) >= self.max_widgets:
+                focus_line = self.focus - len(self.head)
+                self.widgets = { focus_line:self.widgets[focus_line] } if focus_line in self.widgets else {}
+            widget = self.widgets[line_no] = LineWidget(self, line_no)
+        return widget
+
+    def __getitem__(self, position):
+        if position < 0:
+            raise IndexError(position)
+        if position < len(self.head):
+            return self.head[position]
+        if position - len(self.head) < len(self.lines):
+            return self.line_widget(position - len(self.head))
+        raise IndexError(position)
+
+    def next_position(self, position):
+        if position + 1 >= len(self.head) + len(self.lines):
+            raise IndexError(position)
+        return position + 1
+
+    def prev_position(self, position):
+        if position <= 0:
+            raise IndexError(position)
+        return position - 1
+
+    def set_focus(self, position):
+        self.focus = position
+        self._modified()
+
+    def insert_head(self, index, widget):
+        self.head.insert(index, widget)
+        if self.focus >= index:
+            self.focus += 1
+        self._modified()
+
+    def pop_head(self, index):
+        widget = self.head.pop(index)
+        if self.focus > index:
+            self.focus -= 1
+        self._modified()
+        return widget
+
+    def focus_line(self, line_no, edit_pos):
+        self.widgets.clear()
+        self.focus = len(self.head) + line_no
+        self.line_widget(line_no).set_edit_pos(edit_pos)
+        self._modified()
+
+    def split_line(self, line_no, edit_pos):
+        """ Break line_no in two at edit_pos, moving the cursor to the start of the second line """
+        line = self.lines[line_no]
+        self.lines[line_no:line_no + 1] = [ line[:edit_pos], line[edit_pos:] ]
+        self.focus_line(line_no + 1, 0)
+
+    def join_lines(self, line_no):
+        """ Append the line after line_no to it, moving the cursor to where they were joined """
+        edit_pos = len(self.lines[line_no])
+        self.lines[line_no:line_no + 2] = [ self.lines[line_no] + self.lines[line_no + 1] ]
+        self.focus_line(line_no, edit_pos)
 
 
 class Content(urwid.ListBox):
@@ -76,14 +189,12 @@ class Content(urwid.ListBox):
     def __init__(self):
         self.header = HeaderWidget()
         self.keywords = KeywordsWidget()
-        self.record_body = BodyWidget()
+        self.record_body = BodyWalker([
+            self.header,
+            urwid.Divider('-')
+        ])
 
-        super(Content, self).__init__(
-            body=urwid.SimpleFocusListWalker([
-                self.header,
-                urwid.Divider('-'),
-                self.record_body
-            ]))
+        super(Content, self).__init__(body=self.record_body)
 
     def keyword_widget_handler(self):
         interaction_mode = self.header.interaction.text
@@ -91,11 +202,12 @@ class Content(urwid.ListBox):
         switch[interaction_mode]()
 
     def show_keywords(self):
-        self.base_widget.body.insert(1, self.keywords)
+        if self.keywords not in self.record_body.head:
+            self.record_body.insert_head(1, self.keywords)
 
     def hide_keywords(self):
-        if len(self.base_widget.body) == 4:
-            self.keywords = self.base_widget.body.pop(1)
+        if self.keywords in self.record_body.head:
+            self.record_body.pop_head(1)
 
 
 class CommandFooter(urwid.Edit):
@@ -108,11 +220,20 @@ class CommandFooter(urwid.Edit):
         self.palette_id = 'COMMAND_FOOTER_BASE'
         self.cmd_pattern = re.compile('(:.\S*)')
         self.clear_before_keypress = False
+        self.showing_status = False
         self.cmd_history = util.UniqueNeighborScrollList()
 
     def clear_text(self):
         self.set_edit_text('')
         self.cmd_history.reset()
+        self.showing_status = False
+
+    def set_status(self, text):
+        """ Show text until the next keypress, unless a command is being typed """
+        if self.get_edit_text() == '' or self.showing_status:
+            self.set_edit_text(text)
+            self.showing_status = True
+            self.clear_before_keypress = True
 
     def cursor_left(self):
         self.set_edit_pos(self.edit_pos-1)
@@ -172,24 +293,56 @@ class Footer(urwid.WidgetPlaceholder):
             original_widget=urwid.Widget()
         )
 
+    @property
+    def command(self):
+        """ The CommandFooter, status set on it while the INSERT footer is shown appears on returning to COMMAND """
+        return self._attributes['COMMAND']
+
     def set_mode(self, mode):
         footer_widget = self._attributes[mode]
         self.original_widget = urwid.AttrMap(footer_widget, attr_map=footer_widget.palette_id)
 
 
-class ScreenController(urwid.curses_display.Screen):
+class ScreenController(urwid.raw_display.Screen):
     def __init__(self):
         super(ScreenController, self).__init__()
+        # Seconds from input being read to the screen being drawn with it, for the most recent draws
+        self.latencies = collections.deque(maxlen=1000)
+        self.input_time = None
         self.palettes = {'INSERT': [('HEADER_BASE', 'white', 'dark magenta'),
                                     ('INSERT_FOOTER_HIGHLIGHT', 'dark gray', 'light gray'),
                                     ('INSERT_FOOTER_BASE', 'white', 'dark magenta')],
                          'COMMAND': [('HEADER_BASE', 'white', 'black'),
-                                     ('COMMAND_FOOTER_BASE', 'dark cyan', 'black')]}
+                                     ('COMMAND_FOOTER_BASE', 'dark cyan', 'black')],
+                         'PICKER': [('HEADER_BASE', 'white', 'black'),
+                                    ('PICKER_FOCUS', 'black', 'light gray'),
+                                    ('PICKER_FOOTER', 'dark cyan', 'black')]}
 
         self.scroll_actions = {'up', 'down', 'page up', 'page down', 'scroll wheel up', 'scroll wheel down'}
 
     def set_palette_mode(self, mode):
         self.register_palette(self.palettes[mode])
+        # Cells drawn with the previous palette are otherwise left as they are
+        self.clear()
+
+    def mark_input(self):
+        """ Note when input arrived, unless input already read is still waiting to be drawn """
+        if self.input_time is None:
+            self.input_time = time.perf_counter()
+
+    def draw_screen(self, size, canvas):
+        super(ScreenController, self).draw_screen(size, canvas)
+        if self.input_time is not None:
+            self.latencies.append(time.perf_counter() - self.input_time)
+            self.input_time = None
+
+    def latency_summary(self):
+        if len(self.latencies) == 0:
+            return 'No keystrokes drawn yet'
+        ordered = sorted(self.latencies)
+        percentile = lambda p: ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000
+        return 'Keystroke to paint over {} draws: median {:.1f}ms, p95 {:.1f}ms, max {:.1f}ms'.format(
+            len(ordered), percentile(0.5), percentile(0.95), ordered[-1] * 1000)
 
 
 class WidgetController(urwid.Frame):
@@ -224,7 +377,10 @@ class WidgetController(urwid.Frame):
 
 class DataController:
     def __init__(self, record):
-        self.data = Data(record)
+        interpretation_cache = InterpretationCache(
+            memfog.config.interpretation_cache_fp, memfog.config.interpretation_cache_size,
+            memfog.config.interpretation_cache_text_limit)
+        self.data = Data(record, interpretation_cache)
         self.interaction_mode = ''
         self.view_mode = ''
 
@@ -251,9 +407,25 @@ class DataController:
                 vars(self.data.raw).update(vars(self.data.interpreted))
 
 
+def make_event_loop(name):
+    """ :param name: select or asyncio """
+    if name == 'asyncio':
+        return urwid.AsyncioEventLoop(loop=asyncio.new_event_loop())
+    return urwid.SelectEventLoop()
+
+
 class UI:
     def __init__(self, context, msg_queue):
-        self.exit_flag = False
+        self.exit_prompt = False
+        self.exiting = False
+
+        # Saves sent to the writer and not yet acknowledged, and whether an insert is among them
+        self.pending_saves = 0
+        self.insert_pending = False
+        self.save_after_insert = False
+        self.save_failed = False
+        self.save_acks = queue.Queue()
+        self.source_writer = ThreadPoolExecutor(max_workers=1)
 
         self.context = context
         self.msg_queue = msg_queue
@@ -265,7 +437,76 @@ class UI:
         self.set_interaction_mode(context.interaction_mode)
         self.set_view_mode(context.view_mode)
 
-        self.ScreenC.run_wrapper(self.run)
+        # The screen is only drawn once the loop is idle after handling input or source updates
+        self.loop = urwid.MainLoop(
+            self.WigetC, screen=self.ScreenC, event_loop=make_event_loop(memfog.config.event_loop),
+            input_filter=self.filter_input, handle_mouse=False)
+
+        # Text read by the watcher from changed PATH sources. The watcher writes to watch_fd to wake the loop
+        # once it has queued some.
+        self.source_updates = queue.Queue()
+        self.watch_fd = self.loop.watch_pipe(self.on_source_updates)
+        # Written to by the thread acknowledging saves
+        self.ack_fd = self.loop.watch_pipe(self.on_save_acks)
+        self.watcher = None
+        self.watch_sources()
+
+        try:
+            self.loop.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.watcher is not None:
+                self.watcher.stop()
+            self.loop.remove_watch_pipe(self.watch_fd)
+            self.loop.remove_watch_pipe(self.ack_fd)
+            self.source_writer.shutdown(wait=True)
+
+        if self.save_failed:
+            print('Unable to save {}, see {}'.format(self.context.record.title, str(memfog.config.writer_log_fp)))
+
+    def watch_sources(self):
+        """ Watch the PATH sources of the interpreted fields in the background, replacing any current watcher """
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+        paths = self.DataC.data.watched_sources()
+        if memfog.config.watch_sources and len(paths) > 0:
+            self.watcher = watcher.watch(paths, self.read_sources, memfog.config.watch_interval)
+
+    def read_sources(self, paths):
+        """ Called by the watcher thread with the paths that changed """
+        self.source_updates.put(self.DataC.data.read_sources(paths))
+        os.write(self.watch_fd, b'.')
+
+    def on_source_updates(self, data):
+        self.apply_source_updates()
+        # Keep the pipe open for the next update
+        return True
+
+    def apply_source_updates(self):
+        """
+        Splice text read from changed sources into the fields showing it
+        :returns: True if any field was changed
+        """
+        updates = []
+        while True:
+            try:
+                updates.extend(self.source_updates.get_nowait())
+            except queue.Empty:
+                break
+
+        if len(updates) == 0:
+            return False
+
+        # Save the view first so text edited in the widgets counts as an edit and is left alone
+        self.DataC.save_view(self.WigetC.dump())
+        changed = self.DataC.data.apply_source_updates(updates)
+        if len(changed) > 0 and self.DataC.view_mode == 'INTERPRETED':
+            view = self.DataC.get_view('INTERPRETED')
+            self.WigetC.set_widget_text({ field_name:view[field_name] for field_name in changed })
+        return len(changed) > 0
 
     def set_interaction_mode(self, mode_id):
         self.DataC.interaction_mode = mode_id
@@ -284,15 +525,64 @@ class UI:
         return self.DataC.data.update_record_context(self.context)
 
     def save(self, context):
-        """ Update database entry for current record using most recent record data """
-        self.msg_queue.put(context)
+        """
+        Update database entry for current record using most recent record data.
+        Returns without waiting for the writer, the footer shows once the save is acknowledged. A new record is
+        only inserted once, saves made before its insert is acknowledged wait for it and are then sent as an
+        update of the inserted row.
+        """
+        footer = self.WigetC.footer.command
 
-        if self.DataC.data.is_interpreted:
-            self.DataC.data.update_interpreted_sources()
+        if self.insert_pending:
+            self.save_after_insert = True
+            footer.set_status('Saving...')
+            return
 
-        # Block until context put into queue is fully processed.
-        # Race condition occurs when adding new records if not present
-        self.msg_queue.join()
+        # The writer gets a copy so the record can keep being edited while it's written
+        record = Record(context.record.row_id, context.record.title, context.record.keywords, context.record.body)
+        snapshot = memfog.QContext(record, context.flag)
+        snapshot.altered_fields = set(context.altered_fields)
+
+        self.insert_pending = context.flag is Flags.INSERTRECORD
+        self.pending_saves += 1
+        self.msg_queue.put(snapshot, on_ack=self.on_save_ack)
+        footer.set_status('Saving...')
+
+        if self.DataC.data.is_interpreted:
+            # Written in order by a single thread so the last save of a source wins
+            self.source_writer.submit(Data.write_sources, self.DataC.data.interpreted_source_writes())
+
+    def on_save_ack(self, context, row_id, saved):
+        """ Called by the writer queue from a background thread once a save is committed or failed """
+        self.save_acks.put((context, row_id, saved))
+        os.write(self.ack_fd, b'.')
+
+    def on_save_acks(self, data):
+        footer = self.WigetC.footer.command
+        while True:
+            try:
+                context, row_id, saved = self.save_acks.get_nowait()
+            except queue.Empty:
+                break
+
+            self.pending_saves -= 1
+            footer.set_status('Record saved' if saved else 'Save failed')
+            if not saved:
+                self.save_failed = True
+
+            if context.flag is Flags.INSERTRECORD:
+                self.insert_pending = False
+                if saved:
+                    self.context.record.row_id = row_id
+                    self.context.flag = Flags.UPDATERECORD
+                if self.save_after_insert:
+                    self.save_after_insert = False
+                    self.save(self.context)
+
+        if self.exiting and self.pending_saves == 0:
+            raise urwid.ExitMainLoop()
+        # Keep the pipe open for the next acknowledgement
+        return True
 
     def export(self, fp, payload):
         """ Creates json file at filepath fp containing data for currently displayed record """
@@ -319,24 +609,27 @@ class UI:
                     self.WigetC.footer.base_widget.set_edit_text(result)
 
                 elif cmd == ':h' or cmd == ':help':
-                    self.WigetC.footer.base_widget.set_edit_text(':export <path>, :insert, :quit, :refresh, :save, :view <mode>')
+                    self.WigetC.footer.base_widget.set_edit_text(':export <path>, :insert, :latency, :quit, :refresh, :save, :view <mode>')
 
                 elif cmd == ':i' or cmd == ':insert':
                     self.WigetC.footer.base_widget.set_edit_text('')
                     self.set_interaction_mode('INSERT')
 
+                elif cmd == ':l' or cmd == ':latency':
+                    self.WigetC.footer.base_widget.set_edit_text(self.ScreenC.latency_summary())
+
                 elif cmd == ':q' or cmd == ':quit':
-                    self.exit_flag = True
+                    self.exit()
 
                 elif cmd == ':s' or cmd == ':save':
                     context = self.update_context()
                     self.save(context)
-                    self.WigetC.footer.base_widget.set_edit_text('Record Saved')
 
                 elif cmd == ':r' or cmd == ':refresh':
                     self.DataC.save_view(self.WigetC.dump())
                     self.DataC.data.refresh_interpretation()
                     self.WigetC.set_widget_text(self.DataC.get_view(self.DataC.view_mode))
+                    self.watch_sources()
 
                 elif cmd == ':v' or cmd == ':view':
                     try:
@@ -372,51 +665,168 @@ class UI:
         else:
             self.WigetC.footer.base_widget.keypress((1,), k)
 
-    def refresh_screen(self, size):
-        canvas = self.WigetC.render(size, focus=True)
-        self.ScreenC.draw_screen(size, canvas)
-
-    def run(self):
-        size = self.ScreenC.get_cols_rows()
-
-        while not self.exit_flag:
-            self.refresh_screen(size)
-            keys = None
+    def evaluate_input(self, size, k):
+        if self.exiting:
+            # Input is ignored while waiting for outstanding saves to be acknowledged
+            return
 
-            while not keys:
-                try:
-                    keys = self.ScreenC.get_input()
-                except KeyboardInterrupt:
-                    return
+        if self.exit_prompt:
+            self.exit_prompt = False
+            if k.lower() == 'y':
+                self.save(self.context)
+            self.wait_for_saves()
+            return
 
-            for k in keys:
-                if k == 'window resize':
-                    size = self.ScreenC.get_cols_rows()
+        if k == 'ctrl x':
+            self.exit()
 
-                elif k == 'ctrl x':
-                    self.exit_flag = True
+        elif k in self.ScreenC.scroll_actions and self.WigetC.focus_position == 'body':
+            self.WigetC.keypress(size, k)
 
-                elif k in self.ScreenC.scroll_actions and self.WigetC.focus_position == 'body':
-                    self.WigetC.keypress(size, k)
+        elif self.DataC.interaction_mode == 'INSERT':
+            if k == 'esc':
+                self.set_interaction_mode('COMMAND')
+            else:
+                self.WigetC.keypress(size, k)
 
-                elif self.DataC.interaction_mode == 'INSERT':
-                    if k == 'esc':
-                        self.set_interaction_mode('COMMAND')
-                    else:
-                        self.WigetC.keypress(size, k)
+        elif self.DataC.interaction_mode == 'COMMAND':
+            self.evaluate_keypress(k)
 
-                elif self.DataC.interaction_mode == 'COMMAND':
-                    self.evaluate_keypress(k)
+    def filter_input(self, keys, raw):
+        """
+        Handle every key read at once, such as a paste, so the screen is drawn once for all of them.
+        Window resizes and mouse events are left to the main loop.
+        """
+        self.ScreenC.mark_input()
+        size = self.ScreenC.get_cols_rows()
+        unhandled = []
+        for k in keys:
+            if isinstance(k, str) and k != 'window resize':
+                self.evaluate_input(size, k)
+            else:
+                unhandled.append(k)
+        return unhandled
 
+    def exit(self):
+        """ Leave the UI, prompting for whether to save first if any field was changed """
         # Force switch to COMMAND mode so command line footer can prompt user if unsaved changes exist
         self.set_interaction_mode('COMMAND')
         context = self.update_context()
 
         if len(context.altered_fields) > 0:
+            # The next key answers the prompt
             self.WigetC.footer.base_widget.set_edit_text('Save change? y/n')
+            self.exit_prompt = True
+        else:
+            self.wait_for_saves()
+
+    def wait_for_saves(self):
+        """ Leave the UI once every save made has been acknowledged """
+        if self.pending_saves == 0 and not self.save_after_insert:
+            raise urwid.ExitMainLoop()
+        self.exiting = True
+        self.WigetC.footer.command.set_status('Waiting for {} save(s)...'.format(self.pending_saves))
+
+
+class MatchWidget(urwid.Text):
+    """ Record ranked by the picker, selectable so the focused match is highlighted """
+    _selectable = True
+
+    def __init__(self, score, row_id, title):
+        super(MatchWidget, self).__init__('[{}%] {}'.format(score, title), wrap='clip')
+        self.row_id = row_id
+
+    def keypress(self, size, key):
+        return key
+
+
+class Picker:
+    """
+    Search as you type record picker. Matches are ranked against a TokenIndex again whenever the query changes,
+    picker_budget seconds at a time with input read in between, so typing is never held up by ranking.
+    Ranking of a query that has since been typed over is dropped.
+    """
+    def __init__(self, index, query=''):
+        """
+        :type index: TokenIndex
+        Sets selected to the row_id of the record picked, None if the picker was left without picking one
+        """
+        self.index = index
+        self.selected = None
+        # Incremented with each change of the query, ranking started by an older generation is stale
+        self.generation = 0
+        self.ranking = None
+
+        self.query = urwid.Edit('Search: ', query)
+        self.matches = urwid.SimpleFocusListWalker([])
+        self.frame = urwid.Frame(
+            body=urwid.ListBox(self.matches),
+            header=urwid.AttrMap(self.query, 'HEADER_BASE'),
+            footer=urwid.AttrMap(urwid.Text(' ENTER Open  ^X Exit'), 'PICKER_FOOTER'),
+            focus_part='header')
+
+        self.ScreenC = ScreenController()
+        self.ScreenC.set_palette_mode('PICKER')
+        self.loop = urwid.MainLoop(
+            self.frame, screen=self.ScreenC, event_loop=make_event_loop(memfog.config.event_loop),
+            input_filter=self.filter_input, handle_mouse=False)
+
+        self.rank()
+        try:
+            self.loop.run()
+        except KeyboardInterrupt:
+            pass
+
+    def rank(self):
+        """ Start ranking the current query, making ranking of any earlier query stale """
+        self.generation += 1
+        if self.ranking is not None:
+            self.ranking.close()
+        self.ranking = self.index.rank(self.query.edit_text, memfog.config.picker_size)
+        self.rank_slice(self.generation)
+
+    def rank_slice(self, generation):
+        """ Rank for up to picker_budget seconds, continuing once the loop has read any new input if not done """
+        if generation != self.generation:
+            return
+
+        deadline = time.perf_counter() + memfog.config.picker_budget
+        try:
+            while time.perf_counter() < deadline:
+                next(self.ranking)
+        except StopIteration as done:
+            self.ranking = None
+            self.show_matches(done.value)
+            return
+        self.loop.set_alarm_in(0, lambda loop, data: self.rank_slice(generation))
+
+    def show_matches(self, matches):
+        """ :param matches: list of (score, row_id, title) tuples, best first """
+        self.matches[:] = [ urwid.AttrMap(MatchWidget(*match), None, focus_map='PICKER_FOCUS') for match in matches ]
+        if len(self.matches) > 0:
+            self.matches.set_focus(0)
+
+    def filter_input(self, keys, raw):
+        """ Apply every key read at once to the query, such as a paste, before ranking it """
+        query = self.query.edit_text
+        size = self.ScreenC.get_cols_rows()
+        unhandled = []
+        for k in keys:
+            if not isinstance(k, str) or k == 'window resize':
+                unhandled.append(k)
+            elif k == 'ctrl x' or k == 'esc':
+                raise urwid.ExitMainLoop()
+            elif k == 'enter':
+                if len(self.matches) > 0:
+                    self.selected = self.matches[self.matches.focus].base_widget.row_id
+                    raise urwid.ExitMainLoop()
+            elif k == 'up' or k == 'down':
+                position = self.matches.focus + (1 if k == 'down' else -1)
+                if 0 <= position < len(self.matches):
+                    self.matches.set_focus(position)
+            else:
+                self.query.keypress((size[0],), k)
 
-            # refresh so message prompt is drawn to canvas
-            self.refresh_screen(size)
-            k = self.ScreenC.get_input()
-            if k[0].lower() == 'y':
-                self.save(context)
+        if self.query.edit_text != query:
+            self.rank()
+        return unhandled
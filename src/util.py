@@ -1,27 +1,56 @@
 import string
-import shlex
+import heapq
 import itertools
+import re
+
+# Punctuation kept by strip_punctuation
+PUNCTUATION_EXCLUSIONS = ['\'','"', '=']
+_punctuation_table = str.maketrans('', '', ''.join(c for c in string.punctuation if c not in PUNCTUATION_EXCLUSIONS))
+
+# Splits text into the same tokens as a non-posix shlex.shlex lexer.
+# Words start with an ascii word character and may contain quotes, a quote at the start of a token
+# runs to its matching quote, any other character that isn't whitespace is a token by itself.
+_token_pattern = re.compile(r"""
+      [a-zA-Z0-9_][a-zA-Z0-9_'"]*
+    | '[^']*'
+    | "[^"]*"
+    | [^ \t\r\n]
+""", re.VERBOSE)
 
 def is_valid_input(s):
     return len(s) > 0 and s.isdigit() and int(s) >= 0
 
 def strip_punctuation(s):
     """
-    :returns: s stripped of all punctuation not found in exclusions
+    :returns: s stripped of all punctuation not found in PUNCTUATION_EXCLUSIONS
     """
-    exclusions = ['\'','"', '=']
-    return ''.join(c for c in s if c not in string.punctuation or c in exclusions)
+    return s.translate(_punctuation_table)
+
+def tokenize(s):
+    """
+    :returns: list of tokens in s
+    :raises ValueError: if s contains a quote without a closing quote, as shlex does
+    """
+    tokens = _token_pattern.findall(s)
+    for token in tokens:
+        # An opening quote only ends up as a token by itself when its closing quote is missing
+        if token == '\'' or token == '"':
+            raise ValueError('No closing quotation')
+    return tokens
 
 def standardize(s):
     """
     :returns: generator for string tokens extracted from s
+    'this is a, a string!' -> ['this', 'is', 'a', 'a', 'string']
     """
-    stripped = strip_punctuation(s).lower()
+    yield from tokenize(strip_punctuation(s).lower())
 
-    # shlex generates tokens from the provided string
-    # 'this is a, a string!' -> ['this', 'is', 'a', ',', 'string', '!']
-    for token in shlex.shlex(stripped):
-        yield token
+def standardize_many(strings):
+    """
+    Tokenize every string in strings in one call
+    :returns: list containing the list of tokens extracted from each string
+    """
+    return [ tokenize(s.translate(_punctuation_table).lower()) for s in strings ]
 
 def unique_everseen(seq, key_func=None):
     """
@@ -46,6 +75,41 @@ def unique_everseen(seq, key_func=None):
                 seen_add(k)
                 yield item
 
+def chunked(iterable, size):
+    """
+    :returns: generator of lists of up to size consecutive items from iterable
+    chunked('ABCDE', 2) --> AB CD E
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+def top_n(items, n, score_func, bound_func=None):
+    """
+    Select the n highest scoring items while streaming over items, holding at most n items at a time.
+    Ties are won by the later item so the result is equivalent to sorted(items, key=score_func)[-n:].
+    :param n: number of items to keep, 0 keeps every item
+    :param score_func: returns the score of an item
+    :param bound_func: returns an upper bound of the score of an item that is cheaper to compute than score_func.
+                       Items whose bound cannot beat the lowest kept score are skipped without being scored.
+    :returns: list of (score, item) tuples sorted by ascending score
+    """
+    # heap entries are (score, index, item), index breaks ties so items themselves are never compared
+    heap = []
+    for i, item in enumerate(items):
+        if 0 < n <= len(heap):
+            if bound_func is not None and bound_func(item) < heap[0][0]:
+                continue
+            score = score_func(item)
+            if score >= heap[0][0]:
+                heapq.heapreplace(heap, (score, i, item))
+        else:
+            heapq.heappush(heap, (score_func(item), i, item))
+    return [ (score, item) for score, i, item in sorted(heap) ]
+
 class UniqueNeighborScrollList(list):
     """
     built-in list() wrapper with next and prev functionality
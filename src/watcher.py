@@ -0,0 +1,130 @@
+import ctypes
+import os
+import select
+import struct
+import threading
+import time
+
+from .cache import InterpretationCache
+
+# inotify_add_watch mask of directory events that can change the content of a file in it
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# struct inotify_event header, the name that follows is len bytes long
+EVENT_HEADER = struct.Struct('iIII')
+
+# Seconds waited after a change is seen so a burst of writes is reported once
+SETTLE_TIME = 0.05
+
+
+class Watcher(threading.Thread):
+    """
+    Calls on_change from a background thread with the set of paths whose file changed.
+    A change is only reported once the mtime, size or inode of the file differs from when it was last seen.
+    """
+    def __init__(self, paths, on_change, interval):
+        super(Watcher, self).__init__(daemon=True)
+        self.on_change = on_change
+        self.interval = interval
+        self.stamps = { fp:InterpretationCache.stamp(fp) for fp in paths }
+        self.stopped = threading.Event()
+
+    def changed(self, paths):
+        """ :returns: set of the paths in paths whose file changed since it was last seen """
+        changed = set()
+        for fp in paths:
+            stamp = InterpretationCache.stamp(fp)
+            if stamp != self.stamps[fp]:
+                self.stamps[fp] = stamp
+                changed.add(fp)
+        return changed
+
+    def report(self, paths):
+        changed = self.changed(paths)
+        if len(changed) > 0:
+            self.on_change(changed)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class PollingWatcher(Watcher):
+    """ Checks every watched path each interval seconds """
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report(self.stamps)
+
+
+class InotifyWatcher(Watcher):
+    """
+    Waits on inotify events for the directories holding the watched paths, so files replaced by renaming
+    another over them are still followed
+    :raises OSError: if inotify is unavailable
+    """
+    def __init__(self, paths, on_change, interval):
+        super(InotifyWatcher, self).__init__(paths, on_change, interval)
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            inotify_init1, inotify_add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except (AttributeError, OSError):
+            raise OSError('inotify is unavailable')
+
+        self.fd = inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        # Watch descriptor of each directory to the watched paths in it, by file name
+        self.directories = {}
+        for fp in self.stamps:
+            directory, name = os.path.split(os.path.abspath(fp))
+            wd = inotify_add_watch(self.fd, directory.encode(), WATCH_MASK)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for {}'.format(directory))
+            self.directories.setdefault(wd, {}).setdefault(name.encode(), set()).add(fp)
+
+    def read_events(self):
+        """ :returns: set of the watched paths named by the pending events """
+        paths = set()
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return paths
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+                name = buf[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                paths.update(self.directories.get(wd, {}).get(name, ()))
+                offset += EVENT_HEADER.size + length
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                # Wake up every interval to notice being stopped
+                ready, _, _ = select.select([self.fd], [], [], self.interval)
+                if ready:
+                    time.sleep(SETTLE_TIME)
+                    self.report(self.read_events())
+        finally:
+            os.close(self.fd)
+
+
+def watch(paths, on_change, interval=1.0):
+    """
+    Start watching paths for changes, with inotify where available and polling every interval seconds otherwise
+    :type paths: iterable of file paths
+    :returns: the started Watcher, stop it with Watcher.stop
+    """
+    try:
+        watcher = InotifyWatcher(paths, on_change, interval)
+    except OSError:
+        watcher = PollingWatcher(paths, on_change, interval)
+    watcher.start()
+    return watcher
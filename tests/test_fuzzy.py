@@ -0,0 +1,36 @@
+import random
+
+import pytest
+from fuzzywuzzy import fuzz
+
+from src.fuzzy import sort_tokens, score_partition, score_parallel
+
+
+def baseline_top_n(items, query, n):
+    """ Ranking replaced by util.top_n, token_sort_ratio of every record then a stable sort """
+    scored = [ (fuzz.token_sort_ratio(tokens, query), index) for index, tokens in items ]
+    ranked = sorted(scored, key=lambda pair: pair[0])
+    return ranked[-n:]
+
+def make_items(count, rng):
+    # A small vocabulary so many records tie on score
+    words = ['alpha', 'beta', 'gamma', 'delta', 'notes', 'todo', 'linux', 'python', 'git', 'db']
+    return [ (i, ' '.join(rng.sample(words, rng.randint(1, 4)))) for i in range(count) ]
+
+QUERIES = ['alpha', 'notes todo', 'git python db', 'zzz', '']
+
+@pytest.mark.parametrize('query', QUERIES)
+@pytest.mark.parametrize('n', [0, 1, 5, 10, 500])
+def test_score_partition_matches_baseline(query, n):
+    items = make_items(300, random.Random(1))
+    assert score_partition((items, sort_tokens(query), n)) == baseline_top_n(items, query, n)
+
+@pytest.mark.parametrize('query', QUERIES[:3])
+@pytest.mark.parametrize('n', [0, 10])
+def test_score_parallel_matches_baseline(query, n):
+    items = make_items(300, random.Random(2))
+    assert score_parallel(items, sort_tokens(query), n, jobs=3) == baseline_top_n(items, query, n)
+
+def test_ties_go_to_later_records():
+    items = [ (i, 'same tokens') for i in range(20) ]
+    assert score_partition((items, sort_tokens('same tokens'), 3)) == [(100, 17), (100, 18), (100, 19)]
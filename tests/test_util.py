@@ -0,0 +1,65 @@
+import random
+import shlex
+import string
+
+import pytest
+
+from src import util
+
+
+def shlex_standardize(s):
+    """ util.standardize as implemented with shlex, which the regex tokenizer has to reproduce """
+    exclusions = ['\'','"', '=']
+    stripped = ''.join(c for c in s if c not in string.punctuation or c in exclusions).lower()
+    return list(shlex.shlex(stripped))
+
+def outcome(standardize, s):
+    """ :returns: tokens of s, or the ValueError type when s has an unclosed quote """
+    try:
+        return list(standardize(s))
+    except ValueError:
+        return ValueError
+
+
+FIXED_INPUTS = [
+    '',
+    '   ',
+    'this is a, a string!',
+    'Title With CAPS and_underscores 123',
+    'key=value a==b =lead trail=',
+    'don\'t stop',
+    'say "hello world" now',
+    '\'single quoted\' text',
+    'mixed "double\' quotes"',
+    'word"quoted inside"word',
+    'unclosed "quote',
+    'unclosed \'quote',
+    'trailing quote\'',
+    'tabs\tand\nnewlines\r\nhere',
+    'café naïve über',
+    '中文 mixed with ascii',
+    'emoji \U0001f600 in text',
+    'punctuation!@#$%^&*()-+[]{};:,.<>/?\\|`~ only',
+]
+
+@pytest.mark.parametrize('s', FIXED_INPUTS)
+def test_standardize_matches_shlex(s):
+    assert outcome(util.standardize, s) == outcome(shlex_standardize, s)
+
+def test_unclosed_quote_raises():
+    with pytest.raises(ValueError):
+        list(util.standardize('an "unclosed quote'))
+
+def test_quotes_and_equals_are_kept():
+    assert list(util.standardize('a=b "c, d" \'e!\'')) == ['a', '=', 'b', '"c d"', '\'e\'']
+
+def test_standardize_matches_shlex_on_random_input():
+    alphabet = string.ascii_letters + string.digits + string.punctuation + ' \t\n' + 'éß中\U0001f600'
+    rng = random.Random(0)
+    for _ in range(20000):
+        s = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+        assert outcome(util.standardize, s) == outcome(shlex_standardize, s), repr(s)
+
+def test_standardize_many_matches_standardize():
+    strings = [ s for s in FIXED_INPUTS if outcome(util.standardize, s) is not ValueError ]
+    assert util.standardize_many(strings) == [ list(util.standardize(s)) for s in strings ]